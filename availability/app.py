@@ -1,101 +1,93 @@
 import sqlite3
 import os
-import base64
 import json
-import hmac
-import hashlib
-from flask import Flask, request
-
-app = Flask(__name__)
-
-DB_NAME = "availability.db"
-SCHEMA_FILE = "schema.sql"
-db_initialized = False
+import math
+import sys
+import threading
+from flask import Blueprint, Flask, Response, current_app, request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+from common import db, ledger, limits, listings, metrics, migrations, planner, profiles, ratings, searchcache, serve, tokens
+
+bp = Blueprint("availability", __name__)
+log = metrics.get_logger("availability")
+
+DB_NAME = db.data_path("availability", "availability.db")
+MIGRATIONS_DIR = os.path.join(HERE, "migrations")
+USERS_DB = db.data_path("users", "users.db")
+MAX_PAGE_SIZE = 1000
+BULK_CHUNK_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+SEARCH_FILTERS = ("day", "driver", "from", "to", "min_price", "max_price")
 
 # part of this, reuses code from my Project 2 submission for CSE 380.
 # Additional code come from instructor-provided checkpoint examples and lecture.
 
-def create_db():
-    global db_initialized
-    conn = sqlite3.connect(DB_NAME)
-    with open(SCHEMA_FILE, "r") as f:
-        conn.executescript(f.read())
-    conn.commit()
-    conn.close()
-    db_initialized = True
-
-def get_db():
-    global db_initialized
-    if not db_initialized:
-        create_db()
-    return sqlite3.connect(DB_NAME)
-
-def validate_token(token):
-    try:
-        if token is None:
-            return None
-
-        parts = token.split(".")
-        if len(parts) != 3:
-            return None
+def migrate_db():
+    migrations.migrate(DB_NAME, MIGRATIONS_DIR)
 
-        header_b64, payload_b64, signature = parts
+def warm_db():
+    threads = int(serve.setting("availability", "THREADS"))
+    db.preload(DB_NAME)
+    db.warm(DB_NAME, connections=threads)
+    db.warm(USERS_DB, ((profiles.LOOKUP_SQL, ("",)),), connections=threads)
+    tokens.signing_key.get()
 
-        with open("key.txt", "r") as f:
-            key = f.read().strip()
-
-        msg = f"{header_b64}.{payload_b64}".encode()
-        expected = hmac.new(key.encode(), msg, hashlib.sha256).hexdigest()
-
-        if not hmac.compare_digest(expected, signature):
-            return None
-
-        payload_json = base64.urlsafe_b64decode(payload_b64).decode()
-        payload = json.loads(payload_json)
-        return payload.get("username")
-    except:
-        return None
+def get_db():
+    return db.connect(DB_NAME)
 
-def extract_username(token):
-    try:
-        parts = token.split(".")
-        payload_b64 = parts[1]
-        payload_json = base64.b64decode(payload_b64 + "==").decode()
-        payload = json.loads(payload_json)
-        return payload["username"]
-    except:
-        return None
+def clear_db(vacuum=False):
+    migrate_db()
+    db.truncate(DB_NAME, vacuum)
+    listings.invalidate(DB_NAME)
+    planner.invalidate(DB_NAME)
+    searchcache.bump(DB_NAME)
 
-@app.route("/clear", methods=["GET", "POST"])
+@bp.route("/clear", methods=["GET", "POST"])
 def clear():
-    if os.path.exists(DB_NAME):
-        os.remove(DB_NAME)
-    global db_initialized
-    db_initialized = False
+    vacuum = request.args.get("vacuum") == "1"
+    if request.args.get("async") == "1":
+        threading.Thread(target=clear_db, args=(vacuum,), daemon=True).start()
+    else:
+        clear_db(vacuum)
     return {"status": 1}
 
-@app.route("/listing", methods=["POST"])
+def is_driver(username):
+    try:
+        return profiles.is_driver(USERS_DB, username)
+    except:
+        return False
+
+def parse_price(value):
+    # Rounded to whole cents the way the booking charges it (ledger.to_cents),
+    # so the price a listing is shown at is the price paid. NaN and infinity
+    # are refused: SQLite would store NaN as NULL.
+    price = float(value)
+    if not math.isfinite(price) or price < 0:
+        raise ValueError(f"not a price: {value!r}")
+    return ledger.to_cents(value) / 100
+
+def parse_seats(value):
+    # How many reservations the listing takes; one unless given.
+    if value is None or value == "":
+        return 1
+    seats = int(value)
+    if seats < 1:
+        raise ValueError("seats must be at least 1")
+    return seats
+
+@bp.route("/listing", methods=["POST"])
 def listing():
     token = request.headers.get("Authorization")
     if not token:
         return {"status": 2}
 
-    username = extract_username(token)
+    username = tokens.validate_token(token)
     if not username:
         return {"status": 2}
 
-    try:
-        conn_users = sqlite3.connect("../users/users.db")
-        cur_users = conn_users.cursor()
-        cur_users.execute(
-            "SELECT driver FROM user WHERE username=?", (username,)
-        )
-        row = cur_users.fetchone()
-        conn_users.close()
-
-        if not row or row[0] != "True":
-            return {"status": 2}
-    except:
+    if not is_driver(username):
         return {"status": 2}
 
     data = request.form
@@ -103,62 +95,114 @@ def listing():
     day = data.get("day")
     price = data.get("price")
 
+    try:
+        price = parse_price(price)
+        seats = parse_seats(data.get("seats"))
+    except (TypeError, ValueError):
+        return {"status": 2}
+
     conn = get_db()
     cur = conn.cursor()
     cur.execute(
-        "INSERT INTO availability(listingid, username, day, price) VALUES(?,?,?,?)",
-        (listingid, username, day, price)
+        "INSERT INTO availability(listingid, username, day, price, seats) VALUES(?,?,?,?,?)",
+        (listingid, username, day, price, seats)
     )
     conn.commit()
-    conn.close()
+    searchcache.bump(DB_NAME)
 
     return {"status": 1}
 
-@app.route("/search", methods=["GET"])
-def search():
-    auth = request.headers.get("Authorization")
-    username = validate_token(auth)
-    if not username:
-        return {"status": 2}
+def read_bulk_items():
+    # Either one JSON array or NDJSON (one object per line), read from the
+    # request stream so a large upload is never held as a single string.
+    if request.mimetype == "application/json":
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise ValueError("expected a JSON array")
+        yield from items
+        return
+
+    for line in request.stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def parse_bulk_item(item):
+    try:
+        price = parse_price(item["price"])
+        listingid = item.get("listingid")
+        if listingid is not None:
+            listingid = int(listingid)
+        return (listingid, item.get("day"), price, parse_seats(item.get("seats")))
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return None
 
-    day = request.args.get("day")
+def insert_bulk_chunk(conn, username, chunk, results):
+    # chunk holds (result index, row) pairs that already passed validation.
+    # The fast path is a single executemany; if any row collides, redo the
+    # chunk row by row in one transaction to find out which ones failed.
+    sql = "INSERT INTO availability(listingid, username, day, price, seats) VALUES(?,?,?,?,?)"
+    rows = [(lid, username, day, price, seats) for _, (lid, day, price, seats) in chunk]
+    try:
+        conn.executemany(sql, rows)
+        conn.commit()
+        for index, _ in chunk:
+            results[index] = 1
+        return
+    except sqlite3.IntegrityError:
+        conn.rollback()
 
-    conn = get_db()
     cur = conn.cursor()
-    if day:
-        cur.execute(
-            "SELECT listingid, price, username FROM availability WHERE day = ?",
-            (day,)
-        )
-    else:
-        cur.execute(
-            "SELECT listingid, price, username FROM availability"
-        )
-
-    rows = cur.fetchall()
-    conn.close()
+    for (index, _), row in zip(chunk, rows):
+        try:
+            cur.execute(sql, row)
+            results[index] = 1
+        except sqlite3.IntegrityError:
+            results[index] = 2
+    conn.commit()
 
-    if not rows:
-        return {"status": 1, "data": []}
+@bp.route("/listings/bulk", methods=["POST"])
+@limits.cost(10)
+def listings_bulk():
+    auth = request.headers.get("Authorization")
+    username = tokens.validate_token(auth)
+    if not username or not is_driver(username):
+        return {"status": 2}
 
+    conn = get_db()
+    results = []
+    chunk = []
+    status = 1
+    try:
+        for item in read_bulk_items():
+            row = parse_bulk_item(item)
+            results.append(2)
+            if row is not None:
+                chunk.append((len(results) - 1, row))
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                insert_bulk_chunk(conn, username, chunk, results)
+                chunk = []
+        if chunk:
+            insert_bulk_chunk(conn, username, chunk, results)
+    except ValueError:
+        # Malformed body: chunks already committed stay committed and are
+        # reported, the rest of the upload is not processed.
+        status = 2
+    finally:
+        searchcache.bump(DB_NAME)
+
+    return {
+        "status": status,
+        "inserted": results.count(1),
+        "results": results,
+    }
+
+def format_rows(rows):
     drivers = {row[2] for row in rows}
     rating_map = {}
 
     try:
-        conn_users = sqlite3.connect("../users/users.db")
-        cur_u = conn_users.cursor()
-        if drivers:
-            placeholders = ",".join("?" * len(drivers))
-            cur_u.execute(
-                f"SELECT driver, AVG(rating) "
-                f"FROM ratings "
-                f"WHERE driver IN ({placeholders}) "
-                f"GROUP BY driver",
-                tuple(drivers)
-            )
-            for d, avg in cur_u.fetchall():
-                rating_map[d] = avg
-        conn_users.close()
+        rating_map = ratings.averages(USERS_DB, drivers)
     except:
         pass
 
@@ -168,17 +212,127 @@ def search():
         data.append(
             {
                 "listingid": listingid,
-                "price": f"{float(price):.2f}",
+                "price": ledger.format_cents(ledger.to_cents(price)),
                 "driver": driver,
                 "rating": f"{float(avg):.2f}",
             }
         )
+    return data
+
+def stream_search(sql, params):
+    # Runs after the request's teardown hook, so it checks out its own
+    # connection and gives back anything format_rows() picked up.
+    try:
+        with db.checkout(DB_NAME) as conn:
+            cur = conn.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+                yield "".join(json.dumps(item) + "\n" for item in format_rows(rows))
+    finally:
+        db.release_all()
+
+def wants_stream():
+    if request.args.get("stream") == "1":
+        return True
+    return request.accept_mimetypes.best == "application/x-ndjson"
+
+def search_cost():
+    # Without a filter /search reads every listing (and every driver's
+    # rating), unless a limit stops it early.
+    if any(request.args.get(name) for name in SEARCH_FILTERS):
+        return 1
+    return 2 if request.args.get("limit") else 10
+
+@bp.route("/search", methods=["GET"])
+@limits.cost(search_cost)
+def search():
+    auth = request.headers.get("Authorization")
+    username = tokens.validate_token(auth)
+    if not username:
+        return {"status": 2}
+
+    # Filters: day (exact), from/to (YYYY-MM-DD, inclusive, matched against
+    # listings whose day is a date), min_price/max_price (inclusive) and
+    # driver. common.planner picks the index to answer them with.
+    filters = {}
+    try:
+        for name in ("day", "driver"):
+            if request.args.get(name):
+                filters[name] = request.args[name]
+        for name in ("from", "to"):
+            if request.args.get(name):
+                filters[name] = planner.day_ordinal(request.args[name])
+        for name in ("min_price", "max_price"):
+            if request.args.get(name):
+                filters[name] = float(request.args[name])
+    except ValueError:
+        return {"status": 2}
+
+    # Keyset pagination: ?limit=N returns a "next" cursor ("price:listingid"
+    # of the last row) that is passed back as ?cursor=... for the next page.
+    limit = request.args.get("limit")
+    cursor = request.args.get("cursor")
+    try:
+        limit = min(int(limit), MAX_PAGE_SIZE) if limit else None
+        if limit is not None and limit < 1:
+            return {"status": 2}
+        if cursor:
+            cursor_price, cursor_id = cursor.split(":")
+            cursor = (float(cursor_price), int(cursor_id))
+    except ValueError:
+        return {"status": 2}
+
+    # Streaming mode: one JSON object per line, written as rows come off
+    # the cursor instead of building the whole result first.
+    if wants_stream():
+        sql, params = planner.plan(DB_NAME, filters, cursor, limit)
+        return Response(stream_search(sql, params), mimetype="application/x-ndjson")
+
+    # Read before the query runs; see common.searchcache.
+    version = searchcache.current_version(DB_NAME)
+    key = (tuple(sorted(filters.items())), cursor, limit)
+    etag = searchcache.etag(version, key)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    body = searchcache.lookup(DB_NAME, version, key)
+    if body is not None:
+        response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+        return response
+
+    sql, params = planner.plan(DB_NAME, filters, cursor, limit)
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(sql, params)
+
+    rows = cur.fetchall()
+
+    result = {"status": 1, "data": format_rows(rows) if rows else []}
+    if limit is not None and len(rows) == limit:
+        last_id, last_price, _ = rows[-1]
+        result["next"] = f"{last_price!r}:{last_id}"
+
+    response = current_app.json.response(result)
+    response.set_etag(etag)
+    searchcache.store(DB_NAME, version, key, response.get_data())
+    return response
+
+
+app = Flask(__name__)
+app.register_blueprint(bp)
+db.init_app(app)
+metrics.init_app(app)
+limits.init_app(app)
 
-    data.sort(key=lambda x: float(x["price"]), reverse=True)
-    return {"status": 1, "data": data}
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=9001, debug=False, use_reloader=False)
+    serve.run(app, "availability", 9001, init=migrate_db, warm=warm_db)
 
 
 
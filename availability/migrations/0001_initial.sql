@@ -0,0 +1,31 @@
+-- Databases created before migrations existed (by the old schema.sql)
+-- already have an availability table, with price TEXT. It is rebuilt with
+-- price REAL: the column's affinity turns every numeric price into a REAL,
+-- and rows whose price is not a number (never searchable or bookable) are
+-- dropped. On a new database this copies nothing.
+
+CREATE TABLE IF NOT EXISTS availability(
+    listingid INTEGER PRIMARY KEY,
+    username TEXT,
+    day TEXT,
+    price TEXT
+);
+
+CREATE TABLE availability_v1(
+    listingid INTEGER PRIMARY KEY,
+    username TEXT,
+    day TEXT,
+    price REAL
+);
+
+INSERT INTO availability_v1(listingid, username, day, price)
+SELECT listingid, username, day, price FROM availability;
+
+DELETE FROM availability_v1 WHERE typeof(price) <> 'real';
+
+DROP TABLE availability;
+ALTER TABLE availability_v1 RENAME TO availability;
+
+CREATE INDEX availability_day_price ON availability(day, price DESC, listingid DESC);
+CREATE INDEX availability_price ON availability(price DESC, listingid DESC);
+CREATE INDEX availability_username ON availability(username);
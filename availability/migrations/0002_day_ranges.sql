@@ -0,0 +1,19 @@
+-- Range search (/search?from=&to=&min_price=&max_price=&driver=).
+--
+-- day stays free text; day_ord is its typed form, the day number
+-- (date.toordinal()) of a YYYY-MM-DD day and NULL for anything else, so
+-- listings posted with "mon" or "d1" keep working and simply never match a
+-- date range. It is a virtual column: the writers do not change, and the
+-- value is only stored in the index.
+
+ALTER TABLE availability ADD COLUMN day_ord INTEGER GENERATED ALWAYS AS (
+    CASE WHEN day GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]' AND date(day) = day
+         THEN CAST(julianday(day) - 1721424.5 AS INTEGER)
+    END
+) VIRTUAL;
+
+CREATE INDEX availability_date_price ON availability(day_ord, price DESC, listingid DESC);
+
+-- Per-driver searches come back in price order straight off the index.
+DROP INDEX IF EXISTS availability_username;
+CREATE INDEX availability_driver_price ON availability(username, price DESC, listingid DESC);
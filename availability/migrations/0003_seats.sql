@@ -0,0 +1,25 @@
+-- Capacity: a listing takes up to `seats` reservations. The reservation
+-- engine bumps `booked` inside the booking transaction, and `available`
+-- follows from the two.
+--
+-- The /search indexes are rebuilt as partial indexes over available
+-- listings only, so booked-out listings drop out of them entirely and
+-- /search (which always filters on available = 1) never reads them.
+-- Listings reserved before this migration keep booked = 0 here (this
+-- database cannot see the reservations); the reservations table refuses a
+-- second booking of their seat, and that attempt corrects booked (see
+-- common/booking.py).
+
+ALTER TABLE availability ADD COLUMN seats INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE availability ADD COLUMN booked INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE availability ADD COLUMN available INTEGER GENERATED ALWAYS AS (booked < seats) VIRTUAL;
+
+DROP INDEX availability_day_price;
+DROP INDEX availability_price;
+DROP INDEX availability_date_price;
+DROP INDEX availability_driver_price;
+
+CREATE INDEX availability_day_price ON availability(day, price DESC, listingid DESC) WHERE available = 1;
+CREATE INDEX availability_price ON availability(price DESC, listingid DESC) WHERE available = 1;
+CREATE INDEX availability_date_price ON availability(day_ord, price DESC, listingid DESC) WHERE available = 1;
+CREATE INDEX availability_driver_price ON availability(username, price DESC, listingid DESC) WHERE available = 1;
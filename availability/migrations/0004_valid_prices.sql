@@ -0,0 +1,7 @@
+-- /listing and /listings/bulk used to accept any float as a price. NaN is
+-- stored as NULL (and broke every /search that matched the row); infinity,
+-- negative prices and prices above ledger.MAX_CENTS can never be charged.
+-- None of these listings could be booked, so they are dropped.
+
+DELETE FROM availability
+WHERE price IS NULL OR NOT (price >= 0 AND price <= 10000000000);
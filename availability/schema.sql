@@ -1,8 +0,0 @@
-DROP TABLE IF EXISTS availability;
-
-CREATE TABLE availability(
-    listingid INTEGER PRIMARY KEY,
-    username TEXT,
-    day TEXT,
-    price TEXT
-);
\ No newline at end of file
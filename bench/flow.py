@@ -0,0 +1,351 @@
+"""End-to-end benchmark for the four services.
+
+Starts users, availability, reservations and payments locally, seeds users,
+drivers and listings through the public endpoints, then drives a mixed
+workload (login, search, reserve, rate, add, view, history) and reports
+throughput and p50/p95/p99 latency per endpoint.
+
+    python bench/flow.py --users 200 --drivers 20 --listings 2000 \\
+        --concurrency 16 --duration 30 --out results.json
+    python bench/flow.py ... --compare results.json
+
+Pass --no-start to benchmark services that are already running, and
+--server-mode wsgi/asgi to start them under gunicorn (see common/serve.py).
+--monolith starts all four in one process (monolith/app.py) instead.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVICES = {
+    "users": 9000,
+    "availability": 9001,
+    "reservations": 9002,
+    "payments": 9003,
+}
+
+# name: (service, method, path, weight)
+ENDPOINTS = {
+    "login": ("users", "POST", "/login", 10),
+    "search": ("availability", "GET", "/search", 40),
+    "search_day": ("availability", "GET", "/search", 20),
+    "reserve": ("reservations", "POST", "/reserve", 10),
+    "rate": ("users", "POST", "/rate", 5),
+    "add": ("payments", "POST", "/add", 5),
+    "reservations_view": ("reservations", "GET", "/view", 5),
+    "reservations_history": ("reservations", "GET", "/history", 5),
+    "payments_view": ("payments", "GET", "/view", 5),
+}
+
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+class Client:
+    # One keep-alive connection per service per worker thread.
+
+    def __init__(self, host):
+        self.host = host
+        self._local = threading.local()
+
+    def _conn(self, service):
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get(service)
+        if conn is None:
+            conn = conns[service] = http.client.HTTPConnection(self.host, SERVICES[service], timeout=30)
+        return conn
+
+    def call(self, service, method, path, form=None, token=None, query=None, body=None, content_type=None):
+        headers = {}
+        if token:
+            headers["Authorization"] = token
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            content_type = "application/x-www-form-urlencoded"
+        if content_type:
+            headers["Content-Type"] = content_type
+        if query:
+            path = path + "?" + urllib.parse.urlencode(query)
+
+        for attempt in (0, 1):
+            conn = self._conn(service)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                return resp.status, data
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                self._local.conns.pop(service, None)
+                if attempt:
+                    raise
+
+
+def start_services(server_mode, monolith=False):
+    env = dict(os.environ)
+    if server_mode:
+        env["SERVER_MODE"] = server_mode
+    if monolith:
+        return [subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "monolith", "app.py")],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )]
+    procs = []
+    for service in SERVICES:
+        procs.append(subprocess.Popen(
+            [sys.executable, "app.py"],
+            cwd=os.path.join(ROOT, service),
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ))
+    return procs
+
+
+def wait_ready(client, timeout=30):
+    deadline = time.monotonic() + timeout
+    for service in SERVICES:
+        while True:
+            try:
+                client.call(service, "GET", "/metrics")
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{service} did not start")
+                time.sleep(0.2)
+
+
+def seed(client, args, rng):
+    for service in SERVICES:
+        client.call(service, "GET", "/clear")
+
+    riders = [f"rider{i}" for i in range(args.users)]
+    drivers = [f"driver{i}" for i in range(args.drivers)]
+
+    def create(name, driver):
+        client.call("users", "POST", "/create_user", form={
+            "username": name,
+            "password": "pw-" + name,
+            "salt": "salt-" + name,
+            "deposit": str(args.deposit),
+            "driver": "True" if driver else "False",
+        })
+        status, body = client.call("users", "POST", "/login", form={
+            "username": name, "password": "pw-" + name,
+        })
+        return name, json.loads(body)["jwt"]
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        tokens = dict(pool.map(lambda n: create(n, False), riders))
+        tokens.update(pool.map(lambda n: create(n, True), drivers))
+
+        def post_listing(i):
+            driver = drivers[i % len(drivers)]
+            client.call("availability", "POST", "/listing", token=tokens[driver], form={
+                "listingid": str(i + 1),
+                "day": DAYS[i % len(DAYS)],
+                "price": f"{rng.uniform(5, 100):.2f}",
+            })
+
+        list(pool.map(post_listing, range(args.listings)))
+
+    return riders, drivers, tokens
+
+
+def run_workload(client, args, riders, drivers, tokens):
+    names = list(ENDPOINTS)
+    weights = [ENDPOINTS[name][3] for name in names]
+    samples = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def worker(seed_value):
+        rng = random.Random(seed_value)
+        local = {name: [] for name in names}
+        local_errors = {name: 0 for name in names}
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            service, method, path, _ = ENDPOINTS[name]
+            rider = rng.choice(riders)
+            token = tokens[rider]
+            form = None
+            query = None
+
+            if name == "login":
+                form = {"username": rider, "password": "pw-" + rider}
+                token = None
+            elif name == "search_day":
+                query = {"day": rng.choice(DAYS)}
+            elif name == "reserve":
+                form = {"listingid": str(rng.randint(1, args.listings))}
+            elif name == "rate":
+                form = {"username": rng.choice(drivers), "rating": str(rng.randint(1, 5))}
+            elif name == "add":
+                form = {"amount": f"{rng.uniform(1, 50):.2f}"}
+
+            start = time.perf_counter()
+            try:
+                status, _ = client.call(service, method, path, form=form, token=token, query=query)
+                ok = status == 200
+            except OSError:
+                ok = False
+            elapsed = time.perf_counter() - start
+
+            local[name].append(elapsed)
+            if not ok:
+                local_errors[name] += 1
+
+        with lock:
+            for name in names:
+                samples[name].extend(local[name])
+                errors[name] += local_errors[name]
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(worker, range(args.concurrency)))
+    wall = time.monotonic() - started
+
+    return samples, errors, wall
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(samples, errors, wall):
+    report = {}
+    total = 0
+    for name, values in samples.items():
+        values.sort()
+        total += len(values)
+        report[name] = {
+            "requests": len(values),
+            "errors": errors[name],
+            "throughput": len(values) / wall if wall else 0.0,
+            "p50_ms": _ms(percentile(values, 50)),
+            "p95_ms": _ms(percentile(values, 95)),
+            "p99_ms": _ms(percentile(values, 99)),
+        }
+    report["_total"] = {
+        "requests": total,
+        "errors": sum(errors.values()),
+        "throughput": total / wall if wall else 0.0,
+        "seconds": wall,
+    }
+    return report
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 3)
+
+
+def print_report(report):
+    print(f"{'endpoint':<20}{'reqs':>8}{'err':>6}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in report.items():
+        if name.startswith("_"):
+            continue
+        print(
+            f"{name:<20}{row['requests']:>8}{row['errors']:>6}{row['throughput']:>10.1f}"
+            f"{_fmt(row['p50_ms']):>10}{_fmt(row['p95_ms']):>10}{_fmt(row['p99_ms']):>10}"
+        )
+    total = report["_total"]
+    print(f"{'total':<20}{total['requests']:>8}{total['errors']:>6}{total['throughput']:>10.1f}")
+
+
+def print_comparison(report, baseline):
+    # Side-by-side against an earlier --out file.
+    print(f"\n{'endpoint':<20}{'req/s':>16}{'p50 ms':>18}{'p99 ms':>18}")
+    for name, row in report.items():
+        old = baseline.get(name)
+        if name.startswith("_") or old is None:
+            continue
+        print(
+            f"{name:<20}"
+            f"{_delta(old['throughput'], row['throughput']):>16}"
+            f"{_delta(old['p50_ms'], row['p50_ms']):>18}"
+            f"{_delta(old['p99_ms'], row['p99_ms']):>18}"
+        )
+
+
+def _delta(old, new):
+    if old is None or new is None:
+        return "-"
+    if not old:
+        return f"{new:.1f}"
+    return f"{new:.1f} ({(new - old) / old * 100.0:+.0f}%)"
+
+
+def _fmt(value):
+    return "-" if value is None else f"{value:.2f}"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--drivers", type=int, default=10)
+    parser.add_argument("--listings", type=int, default=1000)
+    parser.add_argument("--deposit", type=float, default=1000.0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=380)
+    parser.add_argument("--server-mode", default=None, help="dev, wsgi or asgi")
+    parser.add_argument("--monolith", action="store_true", help="start the single-process monolith")
+    parser.add_argument("--no-start", action="store_true", help="use services that are already running")
+    parser.add_argument("--out", default=None, help="write the JSON report here")
+    parser.add_argument("--compare", default=None, help="earlier JSON report to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    client = Client(args.host)
+
+    procs = [] if args.no_start else start_services(args.server_mode, args.monolith)
+    try:
+        wait_ready(client)
+        riders, drivers, tokens = seed(client, args, rng)
+        samples, errors, wall = run_workload(client, args, riders, drivers, tokens)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+
+    report = summarize(samples, errors, wall)
+    print_report(report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(report, json.load(f)["endpoints"])
+
+    if args.out:
+        result = {
+            "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+            "timestamp": time.time(),
+            "endpoints": report,
+        }
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
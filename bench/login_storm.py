@@ -0,0 +1,191 @@
+"""Login-storm benchmark for the users service.
+
+Seeds users, then hammers /login at a fixed concurrency while a probe
+thread keeps calling a cheap endpoint on the same service, to show how
+much the KDF work leaks into unrelated requests.
+
+    python bench/login_storm.py --users 200 --concurrency 32 --duration 15
+    KDF_WORKERS=2 python bench/login_storm.py --legacy --out storm.json
+
+--legacy rewrites every seeded row to the old sha256(password + salt) form
+first, so the run also measures rehash-on-login.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flow import ROOT, Client, percentile
+
+sys.path.insert(0, ROOT)
+from common import db
+
+PROBE_PATH = "/metrics"
+
+
+def start_users(server_mode):
+    env = dict(os.environ)
+    if server_mode:
+        env["SERVER_MODE"] = server_mode
+    return subprocess.Popen(
+        [sys.executable, "app.py"],
+        cwd=os.path.join(ROOT, "users"),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def wait_ready(client, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            client.call("users", "GET", PROBE_PATH)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("users did not start")
+            time.sleep(0.2)
+
+
+def seed(client, args):
+    client.call("users", "GET", "/clear")
+    names = [f"storm{i}" for i in range(args.users)]
+
+    def create(name):
+        client.call("users", "POST", "/create_user", form={
+            "username": name,
+            "password": "pw-" + name,
+            "salt": "salt-" + name,
+            "deposit": "0",
+            "driver": "False",
+        })
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(create, names))
+
+    if args.legacy:
+        conn = sqlite3.connect(db.data_path("users", "users.db"))
+        conn.executemany(
+            "UPDATE user SET hash=? WHERE username=?",
+            [(hashlib.sha256(("pw-" + n + "salt-" + n).encode()).hexdigest(), n) for n in names],
+        )
+        conn.commit()
+        conn.close()
+    return names
+
+
+def storm(client, args, names):
+    deadline = time.monotonic() + args.duration
+    logins = []
+    failures = [0]
+    probes = []
+    lock = threading.Lock()
+
+    def login_worker(offset):
+        local = []
+        local_failures = 0
+        i = offset
+        while time.monotonic() < deadline:
+            name = names[i % len(names)]
+            i += args.concurrency
+            start = time.perf_counter()
+            status, body = client.call("users", "POST", "/login", form={
+                "username": name, "password": "pw-" + name,
+            })
+            local.append(time.perf_counter() - start)
+            if status != 200 or json.loads(body).get("status") != 1:
+                local_failures += 1
+        with lock:
+            logins.extend(local)
+            failures[0] += local_failures
+
+    def probe_worker():
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            client.call("users", "GET", PROBE_PATH)
+            probes.append(time.perf_counter() - start)
+            time.sleep(args.probe_interval)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(args.concurrency + 1) as pool:
+        pool.submit(probe_worker)
+        list(pool.map(login_worker, range(args.concurrency)))
+    wall = time.monotonic() - started
+
+    logins.sort()
+    probes.sort()
+    return {
+        "login": _summary(logins, wall, failures[0]),
+        "probe": _summary(probes, wall, 0),
+    }
+
+
+def _summary(values, wall, failures):
+    return {
+        "requests": len(values),
+        "failures": failures,
+        "throughput": len(values) / wall if wall else 0.0,
+        "p50_ms": _ms(percentile(values, 50)),
+        "p95_ms": _ms(percentile(values, 95)),
+        "p99_ms": _ms(percentile(values, 99)),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 3)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--probe-interval", type=float, default=0.01)
+    parser.add_argument("--legacy", action="store_true", help="seed legacy sha256 hashes")
+    parser.add_argument("--server-mode", default=None, help="dev, wsgi or asgi")
+    parser.add_argument("--no-start", action="store_true", help="use a users service that is already running")
+    parser.add_argument("--out", default=None, help="write the JSON report here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    client = Client(args.host)
+
+    proc = None if args.no_start else start_users(args.server_mode)
+    try:
+        wait_ready(client)
+        names = seed(client, args)
+        report = storm(client, args, names)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    for name, row in report.items():
+        print(
+            f"{name:<8} reqs={row['requests']} fail={row['failures']} "
+            f"req/s={row['throughput']:.1f} p50={row['p50_ms']}ms "
+            f"p95={row['p95_ms']}ms p99={row['p99_ms']}ms"
+        )
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({
+                "config": {k: v for k, v in vars(args).items() if k != "out"},
+                "env": {k: os.environ[k] for k in os.environ if k.startswith(("KDF_", "SCRYPT_", "PBKDF2_", "PASSWORD_"))},
+                "timestamp": time.time(),
+                "results": report,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
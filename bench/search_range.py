@@ -0,0 +1,196 @@
+"""Range-search benchmark for the availability service.
+
+Seeds a large listing table (1M by default) through /listings/bulk, with
+days spread over a year and uniform prices, then runs each /search query
+shape (single day, week, month, price band, driver, ...) at a fixed
+concurrency and reports p50/p95/p99 latency and rows returned per shape.
+
+    python bench/search_range.py --listings 1000000 --out planned.json
+    SEARCH_PLANNER=0 python bench/search_range.py --reuse --compare planned.json
+
+SEARCH_PLANNER=0 lets SQLite choose the index instead of common/planner.py.
+--reuse keeps the listings already in availability.db (from an earlier run
+with the same --listings) instead of seeding again.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flow import Client, percentile, start_services, wait_ready
+
+START = datetime.date(2025, 1, 1)
+UPLOAD_ROWS = 50000
+
+
+def day(offset):
+    return (START + datetime.timedelta(days=offset)).isoformat()
+
+
+# name: query(rng, drivers) -> /search parameters
+SHAPES = {
+    "day": lambda rng, d: {"day": day(rng.randrange(365)), "limit": 20},
+    "week": lambda rng, d: _range(rng, 7, limit=20),
+    "week_under_30": lambda rng, d: _range(rng, 7, limit=20, max_price=30),
+    "week_page_1000": lambda rng, d: _range(rng, 7, limit=1000),
+    "month": lambda rng, d: _range(rng, 30, limit=20),
+    "quarter_under_10": lambda rng, d: _range(rng, 90, limit=20, max_price=10),
+    "year_under_6": lambda rng, d: _range(rng, 365, limit=20, max_price=6),
+    "price_band": lambda rng, d: {"min_price": 40, "max_price": 40.5, "limit": 20},
+    "driver": lambda rng, d: {"driver": rng.choice(d), "limit": 20},
+    "driver_week": lambda rng, d: dict(_range(rng, 7, limit=20), driver=rng.choice(d)),
+    "top": lambda rng, d: {"limit": 20},
+}
+
+
+def _range(rng, days, **extra):
+    first = rng.randrange(365 - days + 1)
+    return dict({"from": day(first), "to": day(first + days - 1)}, **extra)
+
+
+def seed(client, args, rng):
+    client.call("users", "GET", "/clear")
+    drivers = [f"driver{i}" for i in range(args.drivers)]
+    tokens = {}
+    for name in drivers:
+        client.call("users", "POST", "/create_user", form={
+            "username": name,
+            "password": "pw-" + name,
+            "salt": "salt-" + name,
+            "deposit": "0",
+            "driver": "True",
+        })
+        status, body = client.call("users", "POST", "/login", form={
+            "username": name, "password": "pw-" + name,
+        })
+        tokens[name] = json.loads(body)["jwt"]
+
+    if args.reuse:
+        return drivers, tokens
+
+    client.call("availability", "GET", "/clear")
+    uploads = []
+    for start in range(0, args.listings, UPLOAD_ROWS):
+        count = min(UPLOAD_ROWS, args.listings - start)
+        lines = [
+            json.dumps({
+                "listingid": start + i + 1,
+                "day": day(rng.randrange(365)),
+                "price": round(rng.uniform(5, 100), 2),
+            })
+            for i in range(count)
+        ]
+        uploads.append((drivers[len(uploads) % len(drivers)], "\n".join(lines).encode()))
+
+    # One upload at a time: SQLite serializes the writes anyway.
+    started = time.monotonic()
+    inserted = 0
+    for name, body in uploads:
+        status, data = client.call("availability", "POST", "/listings/bulk", token=tokens[name],
+                                   body=body, content_type="application/x-ndjson")
+        inserted += json.loads(data)["inserted"]
+    print(f"seeded {inserted} listings in {time.monotonic() - started:.1f}s")
+    return drivers, tokens
+
+
+def run_shape(client, args, shape, drivers, token, rng):
+    queries = [SHAPES[shape](rng, drivers) for _ in range(args.requests)]
+    latencies = []
+    rows = []
+
+    def one(query):
+        start = time.perf_counter()
+        status, body = client.call("availability", "GET", "/search", token=token, query=query)
+        latencies.append(time.perf_counter() - start)
+        data = json.loads(body)
+        if status == 200 and data.get("status") == 1:
+            rows.append(len(data["data"]))
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(one, queries))
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(latencies) - len(rows),
+        "rows": round(sum(rows) / len(rows), 1) if rows else 0,
+        "p50_ms": _ms(percentile(latencies, 50)),
+        "p95_ms": _ms(percentile(latencies, 95)),
+        "p99_ms": _ms(percentile(latencies, 99)),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 3)
+
+
+def print_report(report, baseline=None):
+    print(f"{'shape':<18}{'reqs':>6}{'err':>5}{'rows':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          + (f"{'base p50':>10}{'base p99':>10}" if baseline else ""))
+    for name, row in report.items():
+        line = (f"{name:<18}{row['requests']:>6}{row['errors']:>5}{row['rows']:>8}"
+                f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}")
+        old = (baseline or {}).get(name)
+        if old:
+            line += f"{old['p50_ms']:>10.2f}{old['p99_ms']:>10.2f}"
+        print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--listings", type=int, default=1000000)
+    parser.add_argument("--drivers", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=200, help="per query shape")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--shapes", default=",".join(SHAPES), help="comma-separated subset")
+    parser.add_argument("--seed", type=int, default=380)
+    parser.add_argument("--reuse", action="store_true", help="keep the listings already seeded")
+    parser.add_argument("--server-mode", default=None, help="dev, wsgi or asgi")
+    parser.add_argument("--monolith", action="store_true", help="start the single-process monolith")
+    parser.add_argument("--no-start", action="store_true", help="use services that are already running")
+    parser.add_argument("--out", default=None, help="write the JSON report here")
+    parser.add_argument("--compare", default=None, help="earlier JSON report to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    client = Client(args.host)
+
+    procs = [] if args.no_start else start_services(args.server_mode, args.monolith)
+    try:
+        wait_ready(client)
+        drivers, tokens = seed(client, args, rng)
+        token = tokens[drivers[0]]
+        report = {}
+        for shape in args.shapes.split(","):
+            report[shape] = run_shape(client, args, shape, drivers, token, random.Random(args.seed))
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["shapes"]
+    print_report(report, baseline)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({
+                "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+                "env": {k: os.environ[k] for k in os.environ if k.startswith("SEARCH_")},
+                "timestamp": time.time(),
+                "shapes": report,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
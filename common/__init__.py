@@ -0,0 +1 @@
+# Shared helpers used by the users, availability, reservations and payments services.
@@ -0,0 +1,83 @@
+import os
+import queue
+import threading
+import time
+
+# Shared machinery for writers that batch: callers put items on a queue and
+# one background thread writes whatever has queued up, up to max_batch items
+# or max_wait seconds after the first one, in a single transaction.
+#
+# Subclasses implement _insert(batch), which writes a batch in one
+# transaction (raising if it could not), and _complete(batch, error), which
+# is told how each item ended: called once for a batch that was written with
+# error None, and once per item, with the exception, for items that were
+# not. A batch that fails is retried one item at a time first, so one bad
+# item only fails itself.
+
+
+class BatchWriter:
+    def __init__(self, name, max_batch, max_wait, capacity=0):
+        self.name = name
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.capacity = capacity
+        self._queue = queue.Queue(capacity)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Started lazily, and again after a fork (gunicorn workers).
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.capacity)
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _put(self, item, timeout=None):
+        # Raises queue.Full if a bounded queue has no room within timeout.
+        self._ensure_thread()
+        self._queue.put(item, timeout=timeout)
+
+    def _running(self):
+        return self._thread is not None and self._pid == os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        try:
+            self._insert(batch)
+        except Exception as e:
+            if len(batch) > 1:
+                for item in batch:
+                    self._write([item])
+                return
+            self._complete(batch, e)
+            return
+        self._complete(batch, None)
+
+    def _insert(self, batch):
+        raise NotImplementedError
+
+    def _complete(self, batch, error):
+        raise NotImplementedError
@@ -0,0 +1,125 @@
+import sqlite3
+
+from common import ledger
+
+# Reservation engine. The renter's ledger charge and the booking row are
+# done on one connection that has availability.db and payments.db ATTACHed,
+# inside a single BEGIN IMMEDIATE transaction. BEGIN IMMEDIATE takes the
+# write lock on every attached file up front, so the balance read and the
+# charge cannot interleave with another /reserve or /add, and a listing
+# cannot be double-booked for the same day. The listing and the renter's
+# profile (opening deposit) are resolved beforehand through common.listings
+# and common.profiles, so unknown ids are rejected without taking the write
+# lock, and users.db is not locked at all.
+#
+# A listing has `seats` places. Each reservation takes the next one
+# (`booked` + 1) in the same transaction as the charge, and a listing with
+# no seat left stops being `available`, which drops it from /search. A
+# booked-out listing is also turned away before BEGIN IMMEDIATE, with a
+# plain read, so retries for it do not queue for the write lock.
+#
+# Listings booked before seats were counted still have booked = 0 while a
+# reservation holds their seat. The first attempt to book one again fails on
+# the reservations' unique index; booked is then set from the reservations
+# that exist (SEATS_CORRECTED), so the listing stops being available instead
+# of failing the same way forever.
+
+RESERVED = 1
+FAILED = 2
+INSUFFICIENT_FUNDS = 3
+# Not booked, but the listing's booked count was corrected; callers report
+# FAILED and drop whatever they cached about the listing's availability.
+SEATS_CORRECTED = 4
+
+AVAILABILITY_ALIAS = "avail"
+PAYMENTS_ALIAS = "pay"
+
+SEATS_SQL = f"SELECT seats, booked FROM {AVAILABILITY_ALIAS}.availability WHERE listingid = ?"
+
+
+def reserve(conn, username, listingid, listing, profile):
+    if listing is None or profile is None:
+        return FAILED
+    day, price, driver = listing
+    price_cents = ledger.to_cents(price)
+
+    cur = conn.cursor()
+    if not _has_seat(cur.execute(SEATS_SQL, (listingid,)).fetchall()):
+        return FAILED
+
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError:
+        return FAILED
+
+    try:
+        # Again, under the write lock.
+        seats = cur.execute(SEATS_SQL, (listingid,)).fetchall()
+        if not _has_seat(seats):
+            conn.rollback()
+            return FAILED
+        seat = seats[0][1] + 1
+
+        balance = ledger.opening_cents(profile[0]) + ledger.delta_cents(cur, username, PAYMENTS_ALIAS)
+        if balance < price_cents:
+            conn.rollback()
+            return INSUFFICIENT_FUNDS
+
+        ledger.append(
+            cur, username, -price_cents, ledger.RESERVATION,
+            ref=str(listingid), ledger=PAYMENTS_ALIAS
+        )
+        ledger.maybe_snapshot(cur, username, ledger=PAYMENTS_ALIAS)
+
+        cur.execute(
+            f"UPDATE {AVAILABILITY_ALIAS}.availability SET booked = ? WHERE listingid = ?",
+            (seat, listingid)
+        )
+        cur.execute(
+            """
+            INSERT INTO main.reservations(listingid, day, driver, renter, price_cents, seat)
+            VALUES(?,?,?,?,?,?)
+            """,
+            (listingid, day, driver, username, price_cents, seat)
+        )
+        conn.commit()
+        return RESERVED
+    except sqlite3.IntegrityError:
+        # UNIQUE(listingid, day, seat): the seat is already taken (only
+        # possible for listings booked before seats were counted).
+        conn.rollback()
+        return SEATS_CORRECTED if _count_seats(conn, listingid) else FAILED
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def release_seats(conn):
+    # Once the reservations are gone, nothing holds a seat.
+    conn.execute(f"UPDATE {AVAILABILITY_ALIAS}.availability SET booked = 0 WHERE booked > 0")
+    conn.commit()
+
+
+def _count_seats(conn, listingid):
+    # Sets booked to the number of reservations the listing has, if it was
+    # lower. Returns whether it changed anything.
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.execute(
+            f"""
+            UPDATE {AVAILABILITY_ALIAS}.availability
+            SET booked = (SELECT COUNT(*) FROM main.reservations WHERE listingid = ?)
+            WHERE listingid = ?
+              AND booked < (SELECT COUNT(*) FROM main.reservations WHERE listingid = ?)
+            """,
+            (listingid, listingid, listingid)
+        )
+        conn.commit()
+        return cur.rowcount > 0
+    except sqlite3.Error:
+        conn.rollback()
+        return False
+
+
+def _has_seat(rows):
+    return bool(rows) and rows[0][1] < rows[0][0]
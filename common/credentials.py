@@ -0,0 +1,100 @@
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common import metrics
+
+# Password hashing for /create_user and /login.
+#
+# Hashes are stored in the existing `hash` column as
+#   scrypt$<n>$<r>$<p>$<hex digest>
+#   pbkdf2_sha256$<iterations>$<hex digest>
+# using the row's `salt`. Older rows hold a bare sha256(password + salt) hex
+# digest; those still verify and are rewritten with the current scheme on the
+# next successful login, as are rows hashed with different cost parameters.
+#
+# The KDF runs on a small dedicated thread pool (hashlib releases the GIL
+# while it works), so at most KDF_WORKERS hashes burn CPU at once and a login
+# storm queues there instead of taking over every request thread. When more
+# than KDF_QUEUE hashes are already waiting, new ones are refused.
+
+ALGORITHM = os.environ.get("PASSWORD_KDF", "scrypt")
+SCRYPT_N = int(os.environ.get("SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = int(os.environ.get("SCRYPT_R", "8"))
+SCRYPT_P = int(os.environ.get("SCRYPT_P", "1"))
+PBKDF2_ITERATIONS = int(os.environ.get("PBKDF2_ITERATIONS", "200000"))
+KDF_WORKERS = int(os.environ.get("KDF_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+KDF_QUEUE = int(os.environ.get("KDF_QUEUE", "64"))
+KDF_WAIT = float(os.environ.get("KDF_WAIT", "0.5"))
+
+
+class Overloaded(Exception):
+    pass
+
+
+def _current_params():
+    if ALGORITHM == "scrypt":
+        return ("scrypt", str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P))
+    if ALGORITHM == "pbkdf2_sha256":
+        return ("pbkdf2_sha256", str(PBKDF2_ITERATIONS))
+    raise ValueError(f"unknown PASSWORD_KDF {ALGORITHM!r}")
+
+
+def _derive(params, password, salt):
+    password = password.encode()
+    salt = salt.encode()
+    if params[0] == "scrypt":
+        n, r, p = (int(x) for x in params[1:])
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * r * n + (1 << 20)).hex()
+    if params[0] == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", password, salt, int(params[1])).hex()
+    raise ValueError(f"unknown hash scheme {params[0]!r}")
+
+
+def _hash(password, salt):
+    params = _current_params()
+    return "$".join(params + (_derive(params, password, salt),))
+
+
+def _verify(password, salt, stored):
+    # Returns (matches, needs_rehash).
+    if "$" not in stored:
+        legacy = hashlib.sha256((password + salt).encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored), True
+
+    *params, digest = stored.split("$")
+    params = tuple(params)
+    matches = hmac.compare_digest(_derive(params, password, salt), digest)
+    return matches, params != _current_params()
+
+
+class KdfPool:
+    def __init__(self, workers=KDF_WORKERS, queue=KDF_QUEUE, wait=KDF_WAIT):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kdf")
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self.wait = wait
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.wait):
+            metrics.registry.inc("kdf_rejected_total", ())
+            raise Overloaded()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+
+pool = KdfPool()
+
+
+def hash_password(password, salt):
+    return pool.run(_hash, password, salt)
+
+
+def verify_password(password, salt, stored):
+    return pool.run(_verify, password, salt, stored)
@@ -0,0 +1,372 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from common import metrics
+
+# Connection pooling shared by all four services. A request checks a
+# connection out once (per thread, per database file) and hands it back in
+# the teardown hook, so handlers no longer pay for open/PRAGMA/close each time.
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
+
+# Per-schema pragmas that also have to be applied to ATTACHed databases.
+SCHEMA_PRAGMAS = ("journal_mode=WAL", "synchronous=NORMAL")
+
+MAX_IDLE = int(os.environ.get("DB_POOL_MAX_IDLE", "16"))
+PRELOAD_BYTES = int(os.environ.get("DB_PRELOAD_MB", "256")) * 1024 * 1024
+
+# Side file rewritten by truncate(); see content_id().
+CLEARED_SUFFIX = "-cleared"
+
+# Each service keeps its files in DATA_DIR/<service>/, and the services open
+# each other's (users.db for profiles, the reservation engine's ATTACHes), so
+# they all need the same DATA_DIR. It defaults to the source tree, i.e. next
+# to each app.py; docker-compose mounts one shared volume for it.
+DATA_DIR = os.environ.get("DATA_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def file_identity(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
+
+
+def data_path(service, name):
+    directory = os.path.join(DATA_DIR, service)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+def marker_id(marker):
+    # Identity of a side file written by write_marker(); None if it has never
+    # been written.
+    try:
+        st = os.stat(marker)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns)
+
+
+def write_marker(marker):
+    # Atomically replace the side file, which gives it a new marker_id() as
+    # seen from every process.
+    tmp = f"{marker}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "w") as f:
+        f.write(f"{time.time()}\n")
+    os.replace(tmp, marker)
+
+
+def content_id(path):
+    # Changes whenever the file is replaced or emptied by truncate(), in any
+    # process, so in-process caches keyed on it notice a /clear.
+    return (file_identity(path), marker_id(path + CLEARED_SUFFIX))
+
+
+class PerDatabase:
+    # One object per database file (by absolute path), made by
+    # factory(path) on first use: the pools here, and the caches and
+    # writers in the other common modules.
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        obj = self._objects.get(path)
+        if obj is None:
+            with self._lock:
+                obj = self._objects.get(path)
+                if obj is None:
+                    obj = self._objects[path] = self.factory(path)
+        return obj
+
+    def items(self):
+        return list(self._objects.items())
+
+    def values(self):
+        return [obj for _, obj in self.items()]
+
+    def collector(self, prefix):
+        # A metrics collector reporting every object's stats() as
+        # prefix + key, labelled with the database file name.
+        def collect():
+            for path, obj in self.items():
+                labels = (("db", os.path.basename(path)),)
+                for key, value in obj.stats().items():
+                    yield prefix + key, labels, value
+        return collect
+
+
+class ConnectionPool:
+    def __init__(self, path, max_idle=MAX_IDLE):
+        self.path = path
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._generation = 0
+        self.attached = {}
+        self.opened = 0
+        self.reused = 0
+        self.closed = 0
+        self.in_use = 0
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path, timeout=5.0, check_same_thread=False,
+            factory=metrics.InstrumentedConnection,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        for alias, path in self.attached.items():
+            conn.execute("ATTACH DATABASE ? AS " + alias, (path,))
+            for pragma in SCHEMA_PRAGMAS:
+                conn.execute(f"PRAGMA {alias}.{pragma}")
+        self.opened += 1
+        return conn, self._file_id()
+
+    def _file_id(self):
+        ids = [file_identity(self.path)]
+        for path in self.attached.values():
+            ids.append(file_identity(path))
+        return tuple(ids)
+
+    def attach(self, alias, path):
+        with self._lock:
+            self.attached[alias] = os.path.abspath(path)
+            self._generation += 1
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self.closed += 1
+
+    def connect(self):
+        held = getattr(self._local, "held", None)
+        if held is not None:
+            return held[0]
+
+        entry = self.acquire()
+        self._local.held = entry
+        return entry[0]
+
+    def acquire(self):
+        # Check a connection out without binding it to the current thread.
+        # Returns the pool entry that has to be given back to checkin().
+        current = self._file_id()
+        entry = None
+        with self._lock:
+            while self._idle:
+                conn, file_id, generation = self._idle.pop()
+                # The file may have been removed and recreated underneath us
+                # (e.g. restored from a backup); never hand out a connection
+                # that still points at the old inode.
+                if file_id == current and generation == self._generation:
+                    entry = (conn, file_id, generation)
+                    self.reused += 1
+                    break
+                self._discard(conn)
+            generation = self._generation
+            self.in_use += 1
+
+        if entry is None:
+            conn, file_id = self._open()
+            entry = (conn, file_id, generation)
+        return entry
+
+    def release(self):
+        held = getattr(self._local, "held", None)
+        if held is None:
+            return
+        self._local.held = None
+        self.checkin(held)
+
+    def checkin(self, held):
+        conn, file_id, generation = held
+
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            with self._lock:
+                self.in_use -= 1
+            return
+
+        with self._lock:
+            self.in_use -= 1
+            if generation == self._generation and len(self._idle) < self.max_idle:
+                self._idle.append(held)
+                return
+        self._discard(conn)
+
+    def reset(self):
+        # Drop every idle connection and make sure checked-out ones are not
+        # returned to the pool. Used before a database file is replaced.
+        self.release()
+        with self._lock:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "opened": self.opened,
+                "reused": self.reused,
+                "closed": self.closed,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+            }
+
+
+class ChangeWatcher:
+    # Cheap "has anybody written to this file since I last looked" check for
+    # in-process caches. PRAGMA data_version changes whenever another
+    # connection commits, and a new inode means the file was replaced.
+    # Callers serialize access with their own lock.
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._conn = None
+        self._file_id = None
+        self._version = None
+
+    def changed(self):
+        file_id = file_identity(self.path)
+        if self._conn is None or file_id != self._file_id:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._file_id = file_id
+            self._version = None
+
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._version:
+            self._version = version
+            return True
+        return False
+
+
+_pools = PerDatabase(ConnectionPool)
+get_pool = _pools.get
+
+
+def connect(path):
+    return get_pool(path).connect()
+
+
+@contextmanager
+def checkout(path):
+    # For work that outlives the request's teardown hook, such as a
+    # streamed response body.
+    pool = get_pool(path)
+    entry = pool.acquire()
+    try:
+        yield entry[0]
+    finally:
+        pool.checkin(entry)
+
+
+def attach(path, alias, other_path):
+    # Every connection handed out for `path` will have `other_path`
+    # attached as `alias`, so one transaction can span both files.
+    get_pool(path).attach(alias, other_path)
+
+
+def release_all(exc=None):
+    for pool in _pools.values():
+        pool.release()
+
+
+def truncate(path, vacuum=False):
+    # Empty every table in place, in one transaction. Unlike deleting the
+    # file, this keeps the schema and every open connection valid; other
+    # processes see the commit (PRAGMA data_version) and the rewritten
+    # CLEARED_SUFFIX file (content_id). VACUUM also gives the space back.
+    with checkout(path) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tables = [row[0] for row in conn.execute(
+                "SELECT name FROM main.sqlite_master "
+                "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()]
+            for table in tables:
+                conn.execute(f'DELETE FROM main."{table}"')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if vacuum:
+            conn.execute("VACUUM")
+
+    write_marker(path + CLEARED_SUFFIX)
+
+
+def preload(path, limit=PRELOAD_BYTES):
+    # Read the file once so its pages are in the OS page cache, which every
+    # worker process shares.
+    remaining = limit
+    for suffix in ("", "-wal"):
+        try:
+            with open(path + suffix, "rb") as f:
+                while remaining > 0:
+                    chunk = f.read(min(1 << 20, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+        except OSError:
+            pass
+
+
+def warm(path, statements=(), connections=1):
+    # Open `connections` pooled connections up front and run each
+    # (sql, params) once on every one of them, so the first requests neither
+    # connect nor parse the schema or those statements. Best effort: another
+    # service's database may not exist yet, and must not be created here.
+    if not os.path.exists(path):
+        return
+    pool = get_pool(path)
+    entries = [pool.acquire() for _ in range(connections)]
+    try:
+        for conn, _, _ in entries:
+            conn.execute("SELECT count(*) FROM sqlite_master").fetchall()
+            for sql, params in statements:
+                conn.execute(sql, params).fetchall()
+    except sqlite3.Error:
+        pass
+    finally:
+        for entry in entries:
+            pool.checkin(entry)
+
+
+def close_all():
+    # Called before forking worker processes: SQLite handles must not be
+    # shared across fork().
+    for pool in _pools.values():
+        pool.reset()
+
+
+metrics.registry.register(_pools.collector("db_pool_"))
+
+
+def init_app(app):
+    app.teardown_request(release_all)
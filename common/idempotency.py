@@ -0,0 +1,258 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+
+from common import db, metrics
+
+# Idempotency-Key support for the non-idempotent writes (/add, /reserve).
+#
+# A client that retries a timed-out request sends the same Idempotency-Key
+# header. The first request with a key claims it and runs; its response is
+# stored for TTL seconds and every later request with that key (for the same
+# route and user) gets the stored response back without re-running the
+# write, so a retry cannot charge or book twice.
+#
+# Keys live in a small SQLite file next to the service's own database, so
+# they survive restarts and are shared by gunicorn workers, with a bounded
+# in-memory LRU in front of it. A request whose key is still being processed
+# by someone else waits up to PENDING_WAIT for that result (409 after that);
+# reusing a key with different form data is refused with 422.
+#
+# A claim whose process died before answering (a worker killed on timeout,
+# a deploy) would otherwise block its key for the whole TTL, so a claim that
+# is still unanswered after LEASE seconds is taken over by the next request.
+# LEASE has to be longer than any request can run (gunicorn's TIMEOUT).
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+TTL = float(os.environ.get("IDEMPOTENCY_TTL", "86400"))
+CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000"))
+MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", "100000"))
+PENDING_WAIT = float(os.environ.get("IDEMPOTENCY_PENDING_WAIT", "5.0"))
+LEASE = float(os.environ.get("IDEMPOTENCY_LEASE", "60"))
+PURGE_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    id INTEGER PRIMARY KEY,
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    response TEXT,
+    created REAL NOT NULL,
+    UNIQUE(scope, key)
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_created ON idempotency_keys(created);
+"""
+
+
+def fingerprint(form):
+    items = sorted(form.items(multi=True))
+    return hashlib.sha256(json.dumps(items).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, path, ttl=TTL, cache_size=CACHE_SIZE, max_keys=MAX_KEYS, lease=LEASE):
+        self.path = path
+        self.ttl = ttl
+        self.lease = lease
+        self.cache_size = cache_size
+        self.max_keys = max_keys
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._content_id = None
+        self._claims = 0
+
+    def _connect(self):
+        # The table is created on first use. A /clear (possibly in another
+        # worker) means every remembered response is stale.
+        content_id = db.content_id(self.path)
+        conn = db.connect(self.path)
+        if content_id[0] is None or content_id != self._content_id:
+            conn.executescript(SCHEMA)
+            conn.commit()
+            with self._lock:
+                self._memory.clear()
+                self._content_id = db.content_id(self.path)
+        return conn
+
+    def _remember(self, scope, key, fingerprint, response, expires):
+        with self._lock:
+            self._memory[(scope, key)] = (fingerprint, response, expires)
+            self._memory.move_to_end((scope, key))
+            while len(self._memory) > self.cache_size:
+                self._memory.popitem(last=False)
+
+    def _recall(self, scope, key):
+        with self._lock:
+            entry = self._memory.get((scope, key))
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                del self._memory[(scope, key)]
+                return None
+            self._memory.move_to_end((scope, key))
+            return entry
+
+    def _load(self, conn, scope, key):
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT fingerprint, response, created
+            FROM idempotency_keys
+            WHERE scope = ? AND key = ? AND created > ?
+            """,
+            (scope, key, time.time() - self.ttl)
+        )
+        return cur.fetchone()
+
+    def _claim(self, conn, scope, key, fingerprint):
+        # Returns the claim time (which identifies this claim), or None.
+        now = time.time()
+        cur = conn.cursor()
+        # An expired row, or a claim whose lease has run out (created is
+        # the claim time until there is a response), is taken over as if it
+        # were not there.
+        cur.execute(
+            """
+            INSERT INTO idempotency_keys(scope, key, fingerprint, response, created)
+            VALUES(?,?,?,NULL,?)
+            ON CONFLICT(scope, key) DO UPDATE SET
+                fingerprint = excluded.fingerprint,
+                response = NULL,
+                created = excluded.created
+            WHERE idempotency_keys.created <= ?
+               OR (idempotency_keys.response IS NULL AND idempotency_keys.created <= ?)
+            """,
+            (scope, key, fingerprint, now, now - self.ttl, now - self.lease)
+        )
+        claimed = cur.rowcount == 1
+        conn.commit()
+
+        self._claims += 1
+        if self._claims % PURGE_EVERY == 0:
+            self.purge(conn)
+        return now if claimed else None
+
+    # _complete() and _forget() only touch the row while it is still this
+    # claim: one that outlived its lease may have been taken over.
+
+    def _complete(self, conn, scope, key, claimed, fingerprint, response):
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE idempotency_keys SET response = ?
+            WHERE scope = ? AND key = ? AND created = ? AND response IS NULL
+            """,
+            (json.dumps(response), scope, key, claimed)
+        )
+        conn.commit()
+        if cur.rowcount == 1:
+            self._remember(scope, key, fingerprint, response, claimed + self.ttl)
+
+    def _forget(self, conn, scope, key, claimed):
+        conn.execute(
+            """
+            DELETE FROM idempotency_keys
+            WHERE scope = ? AND key = ? AND created = ? AND response IS NULL
+            """,
+            (scope, key, claimed)
+        )
+        conn.commit()
+
+    def _wait(self, conn, scope, key):
+        # Someone else holds the key; poll for their response.
+        deadline = time.monotonic() + PENDING_WAIT
+        while True:
+            row = self._load(conn, scope, key)
+            if row is None or row[1] is not None:
+                return row
+            if time.monotonic() >= deadline:
+                return row
+            time.sleep(0.01)
+
+    def _replay(self, entry, fingerprint, source):
+        if entry[0] != fingerprint:
+            metrics.registry.inc("idempotency_conflicts_total", (("reason", "mismatch"),))
+            return {"status": 2}, 422
+        metrics.registry.inc("idempotency_replays_total", (("source", source),))
+        return entry[1]
+
+    def run(self, scope, key, fingerprint, handler):
+        # Returns handler()'s response, or the one already stored for key.
+        conn = self._connect()
+
+        entry = self._recall(scope, key)
+        if entry is not None:
+            return self._replay(entry, fingerprint, "memory")
+
+        claimed = self._claim(conn, scope, key, fingerprint)
+        if claimed is None:
+            row = self._wait(conn, scope, key)
+            if row is None or row[1] is None:
+                metrics.registry.inc("idempotency_conflicts_total", (("reason", "in_flight"),))
+                return {"status": 2}, 409
+            response = json.loads(row[1])
+            self._remember(scope, key, row[0], response, row[2] + self.ttl)
+            return self._replay((row[0], response), fingerprint, "disk")
+
+        metrics.registry.inc("idempotency_claims_total", ())
+        try:
+            response = handler()
+        except BaseException:
+            self._forget(conn, scope, key, claimed)
+            raise
+        self._complete(conn, scope, key, claimed, fingerprint, response)
+        return response
+
+    def purge(self, conn=None):
+        # Drop expired keys, and the oldest ones beyond max_keys.
+        conn = conn or self._connect()
+        conn.execute("DELETE FROM idempotency_keys WHERE created <= ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM idempotency_keys WHERE id <= (SELECT MAX(id) FROM idempotency_keys) - ?",
+            (self.max_keys,)
+        )
+        conn.commit()
+
+    def clear(self):
+        # May run on a background thread (/clear?async=1), so nothing here
+        # may take a thread-bound connection; truncate() checks one out.
+        # The next _connect() sees the new content_id and recreates the
+        # table if it was never there.
+        db.truncate(self.path)
+        with self._lock:
+            self._memory.clear()
+            self._content_id = None
+
+    def stats(self):
+        with self._lock:
+            return {"cached_keys": len(self._memory)}
+
+
+_stores = db.PerDatabase(IdempotencyStore)
+get_store = _stores.get
+
+
+def handle(path, username, handler):
+    # Runs handler() for the current request unless it carries an
+    # Idempotency-Key that has already been answered.
+    key = request.headers.get(HEADER)
+    if key is None:
+        return handler()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return {"status": 2}, 400
+    scope = f"{request.path}:{username}"
+    return get_store(path).run(scope, key, fingerprint(request.form), handler)
+
+
+def clear(path):
+    get_store(path).clear()
+
+
+metrics.registry.register(_stores.collector("idempotency_"))
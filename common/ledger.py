@@ -0,0 +1,158 @@
+import os
+from concurrent.futures import Future
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from common import batching, db, metrics
+
+# Balance ledger. Money is tracked in integer cents as append-only entries
+# in payments.db (`ledger`): positive for /add deposits, negative for
+# reservation charges. The user's opening deposit stays in users.db.
+#
+#   balance = opening deposit + snapshot.delta_cents + SUM(entries after
+#             snapshot.last_entry_id)
+#
+# Every SNAPSHOT_EVERY entries for a user the tail is folded into
+# `balance_snapshot` inside the writing transaction, so a balance read only
+# ever sums a short tail.
+#
+# All queries take the schema name the ledger is visible under, because the
+# payments service has it as `main` while the reservation engine sees it
+# through an ATTACH. The opening deposit is read by the callers (see
+# common.profiles).
+
+SNAPSHOT_EVERY = int(os.environ.get("LEDGER_SNAPSHOT_EVERY", "64"))
+GROUP_COMMIT_MAX = int(os.environ.get("LEDGER_GROUP_COMMIT_MAX", "256"))
+GROUP_COMMIT_WAIT = float(os.environ.get("LEDGER_GROUP_COMMIT_WAIT_MS", "2")) / 1000.0
+
+# Largest amount a single entry may carry: far enough inside SQLite's
+# 64-bit INTEGER that neither an entry nor any realistic SUM() overflows.
+MAX_CENTS = 10 ** 12
+
+DEPOSIT = "deposit"
+RESERVATION = "reservation"
+
+
+def to_cents(value):
+    # Decimal, not float: float("1.005") * 100 rounds down to 100.
+    try:
+        cents = (Decimal(str(value)) * 100).to_integral_value(ROUND_HALF_UP)
+    except InvalidOperation:
+        raise ValueError(f"not an amount: {value!r}")
+    if not cents.is_finite() or abs(cents) > MAX_CENTS:
+        raise ValueError(f"not an amount: {value!r}")
+    return int(cents)
+
+
+def format_cents(cents):
+    return f"{cents / 100:.2f}"
+
+
+def opening_cents(deposit):
+    try:
+        return to_cents(deposit if deposit is not None else 0)
+    except ValueError:
+        return 0
+
+
+def delta_cents(cur, username, ledger="main"):
+    cur.execute(
+        f"""
+        SELECT delta_cents, last_entry_id
+        FROM {ledger}.balance_snapshot
+        WHERE username = ?
+        """,
+        (username,)
+    )
+    row = cur.fetchone()
+    delta, last_entry_id = row if row else (0, 0)
+
+    cur.execute(
+        f"""
+        SELECT COALESCE(SUM(amount_cents), 0)
+        FROM {ledger}.ledger
+        WHERE username = ? AND entry_id > ?
+        """,
+        (username, last_entry_id)
+    )
+    return delta + cur.fetchone()[0]
+
+
+def append(cur, username, amount_cents, kind, ref=None, ledger="main"):
+    cur.execute(
+        f"INSERT INTO {ledger}.ledger(username, amount_cents, kind, ref) VALUES(?,?,?,?)",
+        (username, amount_cents, kind, ref)
+    )
+
+
+def maybe_snapshot(cur, username, ledger="main"):
+    cur.execute(
+        f"""
+        SELECT COUNT(*), COALESCE(SUM(amount_cents), 0), MAX(entry_id)
+        FROM {ledger}.ledger
+        WHERE username = ?
+          AND entry_id > COALESCE(
+              (SELECT last_entry_id FROM {ledger}.balance_snapshot WHERE username = ?), 0)
+        """,
+        (username, username)
+    )
+    count, tail, last_entry_id = cur.fetchone()
+    if count < SNAPSHOT_EVERY:
+        return
+    cur.execute(
+        f"""
+        INSERT INTO {ledger}.balance_snapshot(username, delta_cents, last_entry_id)
+        VALUES(?,?,?)
+        ON CONFLICT(username) DO UPDATE SET
+            delta_cents = delta_cents + excluded.delta_cents,
+            last_entry_id = excluded.last_entry_id
+        """,
+        (username, tail, last_entry_id)
+    )
+    metrics.registry.inc("ledger_snapshots_total", ())
+
+
+class GroupCommitter(batching.BatchWriter):
+    # Deposits need no balance check, so concurrent /add requests hand their
+    # entry to one writer thread, which appends whatever has queued up (up
+    # to GROUP_COMMIT_MAX entries, waiting at most GROUP_COMMIT_WAIT for
+    # more) in a single transaction. Each caller blocks until the commit
+    # that contains its entry; there is no timeout, since a caller that gave
+    # up could not tell whether its entry was written after all.
+
+    def __init__(self, path, max_batch=GROUP_COMMIT_MAX, max_wait=GROUP_COMMIT_WAIT):
+        super().__init__("ledger", max_batch, max_wait)
+        self.path = path
+
+    def submit(self, username, amount_cents, kind, ref=None):
+        future = Future()
+        self._put((username, amount_cents, kind, ref, future))
+        return future.result()
+
+    def _insert(self, batch):
+        with db.checkout(self.path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = conn.cursor()
+                cur.executemany(
+                    "INSERT INTO ledger(username, amount_cents, kind, ref) VALUES(?,?,?,?)",
+                    [item[:4] for item in batch]
+                )
+                for username in {item[0] for item in batch}:
+                    maybe_snapshot(cur, username)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def _complete(self, batch, error):
+        if error is not None:
+            batch[0][4].set_exception(error)
+            return
+        metrics.registry.inc("ledger_commits_total", ())
+        metrics.registry.inc("ledger_entries_total", (), len(batch))
+        for item in batch:
+            item[4].set_result(True)
+
+
+_committers = db.PerDatabase(GroupCommitter)
+get_committer = _committers.get
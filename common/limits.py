@@ -0,0 +1,202 @@
+import math
+import os
+import threading
+import time
+
+from flask import current_app, g, request
+
+from common import metrics, tokens
+
+# Admission control shared by the services: per-client token buckets and
+# load shedding. Either one answers 429 (with Retry-After) before the view
+# runs, so a client that sends more than its share, or a process that is
+# already behind, costs almost nothing per extra request.
+#
+# Buckets are kept per JWT username (verified tokens only, so nobody can
+# spend someone else's) and per client IP; a request has to fit in both.
+# Every route costs 1 token unless its view is decorated with cost(), which
+# takes a number or a function of the current request (an unfiltered /search
+# costs more than one for a single day).
+#
+# Shedding rejects any request that arrives while SHED_MAX_IN_FLIGHT
+# requests are already being handled by this process. Under SERVER_MODE=asgi,
+# QueueGate also sheds requests that would wait behind SHED_MAX_QUEUE others
+# for a thread, before they reach the thread pool.
+#
+# Everything is off unless configured (a rate or threshold of 0 disables
+# it). Like the metrics, state is per process: under gunicorn each worker
+# has its own buckets.
+#
+#   RATE_LIMIT_USER_RATE=20 RATE_LIMIT_USER_BURST=40 python3 app.py
+
+USER_RATE = float(os.environ.get("RATE_LIMIT_USER_RATE", "0"))
+USER_BURST = float(os.environ.get("RATE_LIMIT_USER_BURST", "0")) or USER_RATE * 2
+IP_RATE = float(os.environ.get("RATE_LIMIT_IP_RATE", "0"))
+IP_BURST = float(os.environ.get("RATE_LIMIT_IP_BURST", "0")) or IP_RATE * 2
+MAX_IN_FLIGHT = int(os.environ.get("SHED_MAX_IN_FLIGHT", "0"))
+MAX_QUEUE = int(os.environ.get("SHED_MAX_QUEUE", "0"))
+MAX_BUCKETS = int(os.environ.get("RATE_LIMIT_MAX_BUCKETS", "100000"))
+
+# Retry-After for shed requests, in seconds.
+SHED_RETRY_AFTER = 1
+
+
+def cost(value):
+    # Decorator (under @bp.route) setting what a request to the view costs.
+    def decorate(view):
+        view.limit_cost = value
+        return view
+    return decorate
+
+
+class Limiter:
+    # Token buckets: each key refills at `rate` tokens per second up to
+    # `burst`. rules maps a key kind ("user", "ip") to (rate, burst).
+
+    def __init__(self, rules, max_buckets=MAX_BUCKETS):
+        self.rules = {kind: rule for kind, rule in rules.items() if rule[0] > 0}
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _level(self, kind, key, now):
+        rate, burst = self.rules[kind]
+        bucket = self._buckets.get((kind, key))
+        if bucket is None:
+            return burst
+        return min(burst, bucket[0] + (now - bucket[1]) * rate)
+
+    def take(self, keys, amount):
+        # keys: [(kind, key)]. Takes amount from every bucket, or from none
+        # of them; returns None, or (kind, seconds until it would fit).
+        keys = [(kind, key) for kind, key in keys if kind in self.rules and key]
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for kind, key in keys:
+                rate, burst = self.rules[kind]
+                need = min(amount, burst)
+                level = self._level(kind, key, now)
+                if level < need:
+                    return kind, (need - level) / rate
+                levels.append(level - need)
+            for (kind, key), level in zip(keys, levels):
+                self._buckets[(kind, key)] = [level, now]
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+        return None
+
+    def _prune(self, now):
+        # Caller holds the lock. A bucket that has refilled completely is
+        # the same as no bucket.
+        for (kind, key), bucket in list(self._buckets.items()):
+            if self._level(kind, key, now) >= self.rules[kind][1]:
+                del self._buckets[(kind, key)]
+
+    def stats(self):
+        with self._lock:
+            return {"buckets": len(self._buckets)}
+
+
+limiter = Limiter({"user": (USER_RATE, USER_BURST), "ip": (IP_RATE, IP_BURST)})
+
+_lock = threading.Lock()
+_in_flight = 0
+_pending = 0
+
+
+def _reject(reason, retry_after):
+    route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    metrics.registry.inc("ratelimit_rejections_total", (("route", route), ("reason", reason)))
+    return {"status": 2}, 429, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+def _request_cost(view):
+    value = getattr(view, "limit_cost", 1)
+    return value() if callable(value) else value
+
+
+def _before_request():
+    global _in_flight
+    view = current_app.view_functions.get(request.endpoint)
+    # /metrics is never turned away; an overloaded process is when it
+    # matters most.
+    exempt = view is metrics.metrics_view
+
+    with _lock:
+        shed = not exempt and MAX_IN_FLIGHT and _in_flight >= MAX_IN_FLIGHT
+        if not shed:
+            _in_flight += 1
+            g.limits_admitted = True
+    if shed:
+        return _reject("in_flight", SHED_RETRY_AFTER)
+
+    if exempt or not limiter.rules or view is None:
+        return None
+    username = tokens.validate_token(request.headers.get("Authorization"))
+    denied = limiter.take((("user", username), ("ip", request.remote_addr)), _request_cost(view))
+    if denied is not None:
+        return _reject(*denied)
+    return None
+
+
+def _teardown_request(exc=None):
+    global _in_flight
+    if g.pop("limits_admitted", False):
+        with _lock:
+            _in_flight -= 1
+
+
+class QueueGate:
+    # ASGI middleware in front of the WSGI adapter: counts requests from
+    # arrival until they are done, so that those not yet on a thread
+    # (pending - in flight) are the queue.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _pending
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        with _lock:
+            shed = MAX_QUEUE and _pending - _in_flight >= MAX_QUEUE
+            if not shed:
+                _pending += 1
+        if shed:
+            metrics.registry.inc(
+                "ratelimit_rejections_total", (("route", "<queued>"), ("reason", "queue"))
+            )
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"retry-after", str(SHED_RETRY_AFTER).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": b'{"status":2}\n'})
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            with _lock:
+                _pending -= 1
+
+
+def _collect():
+    with _lock:
+        in_flight, pending = _in_flight, _pending
+    yield "requests_in_flight", (), in_flight
+    yield "requests_queued", (), max(pending - in_flight, 0)
+    yield "ratelimit_buckets", (), limiter.stats()["buckets"]
+
+
+metrics.registry.register(_collect)
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
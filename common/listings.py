@@ -0,0 +1,81 @@
+import threading
+
+from common import db, metrics
+
+# In-process listing index used by /reserve instead of asking the
+# availability service over HTTP. Entries are keyed by listingid and hold
+# (day, price, driver).
+#
+# Those fields never change once a listing exists (a booking only moves
+# availability.booked, which is not cached here), so the index only has to
+# be dropped when the table is emptied: the availability service calls
+# invalidate() on /clear, and other processes notice through
+# db.content_id(). Ids that are not found are not cached, so a listing
+# posted through another process is visible at once.
+
+
+class ListingIndex:
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._content_id = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, listingid):
+        key = str(listingid)
+        content_id = db.content_id(self.path)
+        with self._lock:
+            if content_id != self._content_id:
+                self._entries.clear()
+                self._content_id = content_id
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        cur = db.connect(self.path).cursor()
+        cur.execute(
+            "SELECT day, price, username FROM availability WHERE listingid=?",
+            (listingid,)
+        )
+        row = cur.fetchone()
+        if row is None:
+            return None
+        entry = tuple(row)
+
+        with self._lock:
+            if content_id == self._content_id:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+                self._entries[key] = entry
+        return entry
+
+    def invalidate(self, listingid=None):
+        with self._lock:
+            if listingid is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(listingid), None)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+_indexes = db.PerDatabase(ListingIndex)
+get_index = _indexes.get
+
+
+def lookup(path, listingid):
+    return get_index(path).get(listingid)
+
+
+def invalidate(path, listingid=None):
+    get_index(path).invalidate(listingid)
+
+
+metrics.registry.register(_indexes.collector("listing_index_"))
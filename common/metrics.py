@@ -0,0 +1,209 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from flask import Response, g, request
+
+# Request/SQL instrumentation shared by the services, exposed in Prometheus
+# text format on /metrics. Numbers are per process: under gunicorn each
+# worker reports its own.
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def register(self, collector):
+        # collector() returns an iterable of (name, labels, value) gauges.
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, list(h.counts), h.total, h.count) for key, h in self.histograms.items()
+            )
+
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        for (name, labels), counts, total, count in histograms:
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, counts):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                if name not in seen:
+                    lines.append(f"# TYPE {name} gauge")
+                    seen.add(name)
+                lines.append(f"{name}{_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+registry = Registry()
+
+
+# SQL timing. db.py opens every pooled connection with this factory, so each
+# statement is timed and attributed to its "shape": the SQL text with
+# whitespace collapsed and IN (?,?,...) lists folded together.
+
+_space = re.compile(r"\s+")
+_in_list = re.compile(r"\?(\s*,\s*\?)+")
+_shapes = {}
+
+
+def query_shape(sql):
+    shape = _shapes.get(sql)
+    if shape is None:
+        shape = _in_list.sub("?...", _space.sub(" ", sql).strip())[:200]
+        if len(_shapes) < 10000:
+            _shapes[sql] = shape
+    return shape
+
+
+def _record_sql(sql, started):
+    registry.observe("sql_seconds", (("query", query_shape(sql)),), time.perf_counter() - started)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_sql(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_sql(sql, started)
+
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _record_sql("<script>", started)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        registry.inc("sqlite_connections_opened_total", ())
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection's shortcuts create their cursor internally without
+    # going through cursor(), so route them explicitly.
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+# Leveled logging in place of the old print("[DEBUG] ...") calls. Arguments
+# are only formatted when the level is enabled, so disabled debug lines cost
+# a level check.
+
+def get_logger(service):
+    logger = logging.getLogger(service)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(os.environ.get("LOG_LEVEL", "WARNING").upper())
+        logger.propagate = False
+    return logger
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.pop("metrics_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        labels = (("route", route), ("method", request.method))
+        registry.observe("http_request_seconds", labels, time.perf_counter() - started)
+        registry.inc("http_requests_total", labels + (("status", str(response.status_code)),))
+    return response
+
+
+def metrics_view():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view, methods=["GET"])
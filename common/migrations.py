@@ -0,0 +1,71 @@
+import os
+import re
+import sqlite3
+
+from common import db, metrics
+
+# Versioned schema migrations. Each service keeps numbered scripts in its
+# migrations/ directory (0001_initial.sql, 0002_add_x.sql, ...) and the
+# database records the last one applied in PRAGMA user_version.
+#
+# migrate() runs the missing scripts, in order, inside one BEGIN IMMEDIATE
+# transaction, so concurrent runs (several workers, a CLI run next to a live
+# service) serialize and only the first one does any work. Nothing is ever
+# dropped: a restart keeps its data.
+
+log = metrics.get_logger("migrations")
+
+_script_name = re.compile(r"^(\d+)_[\w.-]+\.sql$")
+
+
+def scripts(directory):
+    # [(version, path)] in version order.
+    found = []
+    for name in os.listdir(directory):
+        match = _script_name.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    found.sort()
+    return found
+
+
+def statements(script):
+    # executescript() would commit our transaction, so split the script
+    # into complete statements (this keeps trigger bodies whole).
+    buffer = ""
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            yield buffer
+            buffer = ""
+    if buffer.strip() and not buffer.strip().startswith("--"):
+        yield buffer
+
+
+def migrate(path, directory):
+    # Returns the schema version the database is at afterwards.
+    pending = scripts(directory)
+    latest = pending[-1][0] if pending else 0
+
+    with db.checkout(path) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            if current > latest:
+                raise RuntimeError(
+                    f"{os.path.basename(path)} is at schema version {current}, "
+                    f"newer than the latest migration ({latest})"
+                )
+            for version, script in pending:
+                if version <= current:
+                    continue
+                with open(script, "r") as f:
+                    for statement in statements(f.read()):
+                        conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+                log.info("%s: applied %s", os.path.basename(path), os.path.basename(script))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return latest
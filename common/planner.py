@@ -0,0 +1,172 @@
+import datetime
+import os
+import threading
+import time
+
+from common import db, metrics
+
+# Query planning for /search. Results always come back in price order
+# (price DESC, listingid DESC, which is also the keyset cursor), and every
+# filter has an index that leads with it and then continues in that order:
+#
+#   driver        availability_driver_price  (username, price, listingid)
+#   day           availability_day_price     (day, price, listingid)
+#   from / to     availability_date_price    (day_ord, price, listingid)
+#   price / none  availability_price         (price, listingid)
+#
+# All four only cover listings with a seat left (WHERE available = 1), which
+# every query repeats so that the index can be used.
+#
+# An equality filter (driver, day) pins one stretch of its index that is
+# already sorted, so it always wins. A date range is not sorted by price: the
+# date index reads every matching row and sorts them, while the price index
+# reads in order and stops after `limit` matches, roughly limit * rows /
+# matches rows in, but has to fetch each of those from the table to check
+# its day (PRICE_SCAN_COST times the work of an index entry). The two cost
+# the same at matches = sqrt(PRICE_SCAN_COST * limit * rows).
+#
+# choose() counts a range's matches exactly up to PROBE_ROWS, which settles
+# narrow ranges however skewed the days are, and beyond that estimates them
+# from the table's size and date span (re-read every STATS_TTL seconds),
+# assuming days are spread evenly. SQLite on its own picks the date index
+# for any range, which is the slow choice for "this month, top 20".
+
+STATS_TTL = float(os.environ.get("SEARCH_STATS_TTL", "10"))
+PROBE_ROWS = int(os.environ.get("SEARCH_PROBE_ROWS", "2000"))
+PRICE_SCAN_COST = 20
+# SEARCH_PLANNER=0 leaves the choice to SQLite (for benchmarking).
+ENABLED = os.environ.get("SEARCH_PLANNER", "1") != "0"
+
+BY_DRIVER = "availability_driver_price"
+BY_DAY = "availability_day_price"
+BY_DATE = "availability_date_price"
+BY_PRICE = "availability_price"
+
+# filter name -> condition, in the order they are added to the WHERE clause
+CONDITIONS = (
+    ("driver", "username = ?"),
+    ("day", "day = ?"),
+    ("from", "day_ord >= ?"),
+    ("to", "day_ord <= ?"),
+    ("min_price", "price >= ?"),
+    ("max_price", "price <= ?"),
+)
+
+
+def day_ordinal(value):
+    # YYYY-MM-DD -> the day number stored in availability.day_ord.
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date().toordinal()
+
+
+def where(filters, names=None):
+    # Only listings with a seat left; every search index is partial on this.
+    clauses = ["available = 1"]
+    params = []
+    for name, condition in CONDITIONS:
+        if name in filters and (names is None or name in names):
+            clauses.append(condition)
+            params.append(filters[name])
+    return clauses, params
+
+
+def build(filters, index, cursor=None, limit=None):
+    clauses, params = where(filters)
+    if cursor:
+        clauses.append("(price, listingid) < (?, ?)")
+        params.extend(cursor)
+
+    sql = "SELECT listingid, price, username FROM availability"
+    if index is not None:
+        sql += f" INDEXED BY {index}"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY price DESC, listingid DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+
+class Planner:
+    def __init__(self, path, stats_ttl=STATS_TTL):
+        self.path = path
+        self.stats_ttl = stats_ttl
+        self._stats = None
+        self._stats_at = 0.0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        # (rows, first day_ord, last day_ord), re-read at most every
+        # stats_ttl seconds. rows counts booked-out listings too (a plain
+        # COUNT(*) is far cheaper than scanning a partial index); the first
+        # and last day are those of available ones.
+        now = time.monotonic()
+        with self._lock:
+            if self._stats is not None and now - self._stats_at < self.stats_ttl:
+                return self._stats
+        cur = db.connect(self.path).cursor()
+        rows = cur.execute("SELECT COUNT(*) FROM availability").fetchone()[0]
+        first = cur.execute(
+            f"SELECT MIN(day_ord) FROM availability INDEXED BY {BY_DATE} WHERE available = 1"
+        ).fetchone()[0]
+        last = cur.execute(
+            f"SELECT MAX(day_ord) FROM availability INDEXED BY {BY_DATE} WHERE available = 1"
+        ).fetchone()[0]
+        with self._lock:
+            self._stats, self._stats_at = (rows, first, last), now
+        return self._stats
+
+    def _count_dates(self, filters, cap):
+        clauses, params = where(filters, ("from", "to"))
+        cur = db.connect(self.path).cursor()
+        cur.execute(
+            f"""
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM availability INDEXED BY {BY_DATE}
+                WHERE {" AND ".join(clauses)}
+                LIMIT ?
+            )
+            """,
+            params + [cap]
+        )
+        return cur.fetchone()[0]
+
+    def _estimate_dates(self, filters):
+        rows, first, last = self.stats()
+        if first is None:
+            return 0
+        low = max(filters.get("from", first), first)
+        high = min(filters.get("to", last), last)
+        return rows * max(high - low + 1, 0) / (last - first + 1)
+
+    def choose(self, filters, limit=None):
+        if "driver" in filters:
+            return BY_DRIVER
+        if "day" in filters:
+            return BY_DAY
+        if "from" in filters or "to" in filters:
+            if limit is None or self._count_dates(filters, PROBE_ROWS) < PROBE_ROWS:
+                return BY_DATE
+            matches = self._estimate_dates(filters)
+            if matches ** 2 < PRICE_SCAN_COST * limit * self.stats()[0]:
+                return BY_DATE
+        return BY_PRICE
+
+    def invalidate(self):
+        with self._lock:
+            self._stats = None
+
+
+_planners = db.PerDatabase(Planner)
+get_planner = _planners.get
+
+
+def plan(path, filters, cursor=None, limit=None):
+    # (sql, params) for one page of /search.
+    index = get_planner(path).choose(filters, limit) if ENABLED else None
+    metrics.registry.inc("search_plans_total", (("index", index or "sqlite"),))
+    return build(filters, index, cursor, limit)
+
+
+def invalidate(path):
+    get_planner(path).invalidate()
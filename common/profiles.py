@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from common import db, metrics
+
+# Read-through cache of the user fields the other services need from
+# users.db: the opening deposit and the driver flag. Entries are keyed by
+# username and hold (deposit, is_driver); unknown users are not cached, so a
+# freshly created user is visible immediately.
+#
+# Neither field changes after /create_user (balance changes go to the
+# ledger), so the only invalidations needed are /create_user and /clear,
+# which the users service does explicitly. Other processes notice /clear
+# through db.content_id(), and every entry also expires after TTL seconds
+# as a backstop.
+
+CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "50000"))
+CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", "60"))
+
+LOOKUP_SQL = "SELECT deposit, driver FROM user WHERE username=?"
+
+
+class ProfileCache:
+    def __init__(self, path, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._content_id = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        content_id = db.content_id(self.path)
+        now = time.monotonic()
+        with self._lock:
+            if content_id != self._content_id:
+                self._entries.clear()
+                self._content_id = content_id
+            entry = self._entries.get(username)
+            if entry is not None:
+                profile, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(username)
+                    self.hits += 1
+                    return profile
+                del self._entries[username]
+            self.misses += 1
+
+        cur = db.connect(self.path).cursor()
+        cur.execute(LOOKUP_SQL, (username,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        profile = (row[0], row[1] == "True")
+
+        with self._lock:
+            if content_id == self._content_id:
+                self._entries[username] = (profile, now + self.ttl)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return profile
+
+    def invalidate(self, username=None):
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+_caches = db.PerDatabase(ProfileCache)
+get_cache = _caches.get
+
+
+def lookup(path, username):
+    # (deposit, is_driver), or None if there is no such user.
+    return get_cache(path).get(username)
+
+
+def is_driver(path, username):
+    profile = lookup(path, username)
+    return profile is not None and profile[1]
+
+
+def invalidate(path, username=None):
+    get_cache(path).invalidate(username)
+
+
+metrics.registry.register(_caches.collector("profile_cache_"))
@@ -0,0 +1,94 @@
+import threading
+
+from common import db, metrics
+
+# Read-through cache of per-driver average ratings. Averages come from the
+# driver_rating_summary table in users.db (kept up to date by a trigger on
+# ratings), so a lookup costs the same no matter how many ratings exist.
+# The cache is dropped whenever users.db changes.
+
+
+class RatingCache:
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._watcher = db.ChangeWatcher(path)
+        self.hits = 0
+        self.misses = 0
+
+    def averages(self, drivers):
+        result = {}
+        missing = []
+        with self._lock:
+            if self._watcher.changed():
+                self._entries.clear()
+            for driver in drivers:
+                if driver in self._entries:
+                    self.hits += 1
+                    avg = self._entries[driver]
+                    if avg is not None:
+                        result[driver] = avg
+                else:
+                    self.misses += 1
+                    missing.append(driver)
+
+        if not missing:
+            return result
+
+        found = {}
+        cur = db.connect(self.path).cursor()
+        # Stay well under SQLite's bound-parameter limit.
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            cur.execute(
+                f"SELECT driver, CAST(rating_sum AS REAL) / rating_count "
+                f"FROM driver_rating_summary "
+                f"WHERE driver IN ({placeholders})",
+                chunk
+            )
+            found.update(cur.fetchall())
+        result.update(found)
+
+        with self._lock:
+            if len(self._entries) + len(missing) > self.max_entries:
+                self._entries.clear()
+            for driver in missing:
+                self._entries[driver] = found.get(driver)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+_caches = db.PerDatabase(RatingCache)
+get_cache = _caches.get
+
+
+def averages(path, drivers):
+    return get_cache(path).averages(drivers)
+
+
+def given(path, rater, users):
+    # {user: average of the ratings rater gave them}, for the users that
+    # rater has rated. Not cached: it changes with every /rate by rater.
+    users = list(users)
+    result = {}
+    cur = db.connect(path).cursor()
+    for i in range(0, len(users), 500):
+        chunk = users[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        cur.execute(
+            f"SELECT driver, AVG(rating) FROM ratings "
+            f"WHERE driver IN ({placeholders}) AND rater = ? "
+            f"GROUP BY driver",
+            chunk + [rater]
+        )
+        result.update(cur.fetchall())
+    return result
+
+
+metrics.registry.register(_caches.collector("rating_cache_"))
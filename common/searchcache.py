@@ -0,0 +1,126 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from common import db, metrics
+
+# Cache of finished /search responses: the serialized JSON body, keyed by
+# the normalized query (filters, cursor, limit), so a repeated search is
+# answered without touching SQLite or re-serializing anything.
+#
+# Every entry belongs to a version of the search data. The version is a side
+# file next to availability.db, rewritten by bump() after every write that
+# can change a search result (/listing, /reserve, /rate, /clear, in whichever
+# service does it) and read back with a stat(), so every process sees a bump
+# at once. An entry is only served while the version it was built under is
+# current. Callers must read current_version() before they query and bump()
+# after they commit; then a result can be stored under an older version than
+# the data it saw, never a newer one.
+#
+# The ETag of a response is derived from (version, key), not from the body,
+# so a matching If-None-Match is answered with a 304 even when the entry
+# itself has been evicted, or was built by another worker.
+
+log = metrics.get_logger("searchcache")
+
+CACHE_BYTES = int(os.environ.get("SEARCH_CACHE_MB", "64")) * 1024 * 1024
+VERSION_SUFFIX = "-search-version"
+
+
+def current_version(path):
+    return db.marker_id(path + VERSION_SUFFIX)
+
+
+def bump(path):
+    # Never fails the write that calls it: a service without access to
+    # availability's directory has no cache there to invalidate.
+    try:
+        db.write_marker(path + VERSION_SUFFIX)
+    except OSError as e:
+        log.warning("could not bump %s: %s", path + VERSION_SUFFIX, e)
+
+
+def etag(version, key):
+    return hashlib.sha1(repr((version, key)).encode()).hexdigest()
+
+
+class SearchCache:
+    def __init__(self, path, max_bytes=CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _switch(self, version):
+        # Caller holds the lock. A request that read the version just before
+        # a bump must not take the cache back to it, so only move to a
+        # version that is still current; older entries can never be served
+        # again.
+        if version == self._version:
+            return True
+        if version != current_version(self.path):
+            return False
+        self._entries.clear()
+        self._bytes = 0
+        self._version = version
+        return True
+
+    def get(self, version, key):
+        with self._lock:
+            body = self._entries.get(key) if self._switch(version) else None
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, version, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if not self._switch(version):
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = body
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+_caches = db.PerDatabase(SearchCache)
+get_cache = _caches.get
+
+
+def lookup(path, version, key):
+    if CACHE_BYTES <= 0:
+        return None
+    return get_cache(path).get(version, key)
+
+
+def store(path, version, key, body):
+    if CACHE_BYTES > 0:
+        get_cache(path).put(version, key, body)
+
+
+metrics.registry.register(_caches.collector("search_cache_"))
@@ -0,0 +1,110 @@
+import os
+import signal
+import sys
+import threading
+
+from common import db, limits
+
+# Serving modes, picked with SERVER_MODE:
+#   dev  - Flask's built-in development server (the default for python3 app.py)
+#   wsgi - gunicorn with several worker processes, each running a thread pool
+#   asgi - gunicorn running uvicorn workers; Flask runs behind an ASGI adapter
+#          that hands every request (and its DB work) to a thread pool executor
+#
+# Every setting can be given per service (USERS_WORKERS=4) or for all
+# services at once (WORKERS=4).
+#
+# `init` (schema migrations) runs once before the port opens: in the
+# gunicorn master, or in the process itself in dev mode. `warm` runs in
+# every process that serves requests, before it takes any. Running
+# `python3 app.py migrate` only runs `init`.
+
+DEFAULTS = {
+    "SERVER_MODE": "dev",
+    "HOST": "0.0.0.0",
+    "WORKERS": "2",
+    "THREADS": "8",
+    "BACKLOG": "2048",
+    "TIMEOUT": "30",
+}
+
+
+def setting(service, name):
+    return os.environ.get(f"{service.upper()}_{name}", os.environ.get(name, DEFAULTS.get(name)))
+
+
+def ports(service, default):
+    # PORT may list several ports ("9000,9001"); the monolith listens on one
+    # per service.
+    value = setting(service, "PORT")
+    if not value:
+        return [default] if isinstance(default, int) else list(default)
+    return [int(port) for port in value.split(",")]
+
+
+def run(app, service, port, init=None, warm=None):
+    mode = setting(service, "SERVER_MODE")
+    host = setting(service, "HOST")
+    binds = ports(service, port)
+
+    if sys.argv[1:] == ["migrate"]:
+        if init is not None:
+            init()
+        return
+
+    if mode == "dev":
+        if init is not None:
+            init()
+        if warm is not None:
+            warm()
+        # Exit through SystemExit on SIGTERM so atexit hooks (e.g. flushing
+        # write-behind queues) get to run.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        # make_server() rather than app.run(): `app` may be any WSGI
+        # callable, such as the monolith's port dispatcher.
+        from werkzeug.serving import make_server
+        servers = [make_server(host, port, app, threaded=True) for port in binds]
+        for server in servers[1:]:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers[0].serve_forever()
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    threads = int(setting(service, "THREADS"))
+    options = {
+        "bind": [f"{host}:{port}" for port in binds],
+        "workers": int(setting(service, "WORKERS")),
+        "backlog": int(setting(service, "BACKLOG")),
+        "timeout": int(setting(service, "TIMEOUT")),
+        "preload_app": True,
+    }
+    if warm is not None:
+        options["post_worker_init"] = lambda worker: warm()
+
+    if mode == "wsgi":
+        options["worker_class"] = "gthread"
+        options["threads"] = threads
+        target = app
+    elif mode == "asgi":
+        from a2wsgi import WSGIMiddleware
+        options["worker_class"] = "uvicorn.workers.UvicornWorker"
+        target = limits.QueueGate(WSGIMiddleware(app, workers=threads))
+    else:
+        raise ValueError(f"unknown SERVER_MODE {mode!r}")
+
+    # One-time setup happens in the master so workers do not race to do it,
+    # and its connections are closed before the fork.
+    if init is not None:
+        init()
+    db.close_all()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return target
+
+    Server().run()
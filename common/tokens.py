@@ -0,0 +1,235 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from common import metrics
+
+# JWT signing/verification shared by every service.
+#
+# Tokens are standard HS256 JWTs: base64url (unpadded) JSON header carrying
+# the signing key's "kid", base64url JSON claims {"username", "iat", "exp"}
+# and a base64url raw HMAC-SHA256 signature. Expired tokens are rejected
+# from the claims alone, before any HMAC work.
+#
+# key.txt holds either a single secret, or several "kid:secret" lines. The
+# first key signs new tokens; the others are still accepted, which is how a
+# key is rotated out. The file is read once and re-read only when its mtime
+# changes. Tokens that already passed the signature check are remembered
+# (until they expire, at most CACHE_TTL) so repeat requests skip it.
+
+KEY_FILE = os.environ.get("TOKEN_KEY_FILE", "key.txt")
+KEY_CHECK_INTERVAL = float(os.environ.get("TOKEN_KEY_CHECK_INTERVAL", "1.0"))
+CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "4096"))
+CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", "60"))
+TOKEN_TTL = int(os.environ.get("TOKEN_TTL", "3600"))
+# How long after expiry a token may still be exchanged on /refresh.
+REFRESH_GRACE = int(os.environ.get("TOKEN_REFRESH_GRACE", "300"))
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class Keyring:
+    def __init__(self, text):
+        self.keys = {}
+        self.active = None
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if ":" in line:
+                kid, secret = line.split(":", 1)
+            else:
+                secret = line
+                kid = hashlib.sha256(secret.encode()).hexdigest()[:8]
+            self.keys[kid] = secret.encode()
+            if self.active is None:
+                self.active = kid
+        if self.active is None:
+            raise ValueError("no signing key configured")
+        # The header only depends on the kid, so encode it once.
+        self.headers = {
+            kid: _b64encode(json.dumps(
+                {"alg": "HS256", "typ": "JWT", "kid": kid}, separators=(",", ":")
+            ).encode())
+            for kid in self.keys
+        }
+        self.kids_by_header = {header: kid for kid, header in self.headers.items()}
+
+
+class SigningKey:
+    def __init__(self, path=KEY_FILE, check_interval=KEY_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._keyring = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self._keyring is not None and now - self._checked_at < self.check_interval:
+            return self._keyring
+
+        with self._lock:
+            if self._keyring is not None and now - self._checked_at < self.check_interval:
+                return self._keyring
+            mtime = os.stat(self.path).st_mtime_ns
+            if self._keyring is None or mtime != self._mtime:
+                with open(self.path, "r") as key_file:
+                    self._keyring = Keyring(key_file.read())
+                self._mtime = mtime
+                self.reloads += 1
+                verified_cache.clear()
+            self._checked_at = now
+            return self._keyring
+
+
+class TokenCache:
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                username, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    return username
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token, username, exp):
+        with self._lock:
+            self._entries[token] = (username, min(exp, time.time() + self.ttl))
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+
+verified_cache = TokenCache()
+signing_key = SigningKey()
+
+
+def generate_token(username):
+    keyring = signing_key.get()
+    kid = keyring.active
+
+    now = int(time.time())
+    claims = {"username": username, "iat": now, "exp": now + TOKEN_TTL}
+    payload_b64 = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+
+    signing_input = keyring.headers[kid] + "." + payload_b64
+    signature = hmac.new(keyring.keys[kid], signing_input.encode(), hashlib.sha256).digest()
+
+    return signing_input + "." + _b64encode(signature)
+
+
+def _verify(token, leeway=0):
+    # Returns the token's claims, or None if it is malformed, expired (more
+    # than `leeway` seconds ago) or not signed by a known key.
+    keyring = signing_key.get()
+
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    header_b64, payload_b64, signature_b64 = parts
+
+    claims = json.loads(_b64decode(payload_b64))
+    exp = claims.get("exp")
+    if not isinstance(exp, (int, float)) or exp + leeway <= time.time():
+        return None
+
+    kid = keyring.kids_by_header.get(header_b64)
+    if kid is None:
+        header = json.loads(_b64decode(header_b64))
+        kid = header.get("kid")
+        if header.get("alg") != "HS256" or kid not in keyring.keys:
+            return None
+
+    expected = hmac.new(keyring.keys[kid], f"{header_b64}.{payload_b64}".encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(expected, _b64decode(signature_b64)):
+        return None
+    return claims
+
+
+def validate_token(token):
+    try:
+        if token is None:
+            return None
+
+        signing_key.get()
+        username = verified_cache.get(token)
+        if username is not None:
+            return username
+
+        claims = _verify(token)
+        if claims is None:
+            return None
+        username = claims.get("username")
+        if username is not None:
+            verified_cache.put(token, username, claims["exp"])
+        return username
+    except Exception:
+        return None
+
+
+def refresh_token(token):
+    # Stateless refresh: a correctly signed token that is still valid, or
+    # expired less than REFRESH_GRACE seconds ago, is exchanged for a new one
+    # signed with the current key.
+    try:
+        if token is None:
+            return None
+        claims = _verify(token, leeway=REFRESH_GRACE)
+        if claims is None or claims.get("username") is None:
+            return None
+        return generate_token(claims["username"])
+    except Exception:
+        return None
+
+
+def token_stats():
+    stats = verified_cache.stats()
+    stats["key_reloads"] = signing_key.reloads
+    return stats
+
+
+def _collect():
+    for key, value in token_stats().items():
+        yield "token_cache_" + key, (), value
+
+
+metrics.registry.register(_collect)
@@ -0,0 +1,71 @@
+import atexit
+import queue
+
+from common import batching, db, metrics
+
+# Write-behind batching for inserts whose caller does not need to wait for
+# the commit (/rate). submit() puts the row on a bounded in-process queue and
+# returns; a background thread inserts whatever has queued up, up to
+# max_batch rows or max_wait seconds after the first one, in a single
+# transaction, so a burst of N requests costs one commit instead of N.
+#
+# on_write, if given, is called after every commit (e.g. to invalidate
+# caches that the rows feed).
+#
+# When the queue is full, submit() waits up to put_wait for room
+# (backpressure) and then writes the row itself, synchronously. Queued rows
+# are flushed at interpreter exit; rows that were acknowledged but not yet
+# written are lost only if the process is killed outright.
+
+log = metrics.get_logger("writebehind")
+
+
+class WriteBehindQueue(batching.BatchWriter):
+    def __init__(self, path, sql, name, max_batch=256, max_wait=0.02, capacity=10000, put_wait=0.05,
+                 on_write=None):
+        super().__init__(name, max_batch, max_wait, capacity)
+        self.path = path
+        self.sql = sql
+        self.on_write = on_write
+        self.put_wait = put_wait
+        atexit.register(self.flush)
+        metrics.registry.register(self._collect)
+
+    def submit(self, params):
+        try:
+            self._put(params, timeout=self.put_wait)
+            return
+        except queue.Full:
+            metrics.registry.inc("writebehind_overflow_total", (("queue", self.name),))
+        self._write([params])
+
+    def flush(self):
+        # Blocks until everything submitted so far has been written.
+        if self._running():
+            self._queue.join()
+
+    def _insert(self, batch):
+        with db.checkout(self.path) as conn:
+            try:
+                conn.executemany(self.sql, batch)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def _complete(self, batch, error):
+        if error is not None:
+            metrics.registry.inc("writebehind_dropped_total", (("queue", self.name),))
+            log.error("%s: dropped %r: %s", self.name, batch[0], error)
+            return
+
+        metrics.registry.inc("writebehind_commits_total", (("queue", self.name),))
+        metrics.registry.inc("writebehind_rows_total", (("queue", self.name),), len(batch))
+        if self.on_write is not None:
+            try:
+                self.on_write()
+            except Exception as e:
+                log.error("%s: on_write failed: %s", self.name, e)
+
+    def _collect(self):
+        yield "writebehind_pending", (("queue", self.name),), self._queue.qsize()
@@ -0,0 +1,89 @@
+import importlib.util
+import os
+import sys
+
+from flask import Flask
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+sys.path.insert(0, ROOT)
+
+# All four services share one key; read it from the users service's copy
+# unless told otherwise.
+os.environ.setdefault("TOKEN_KEY_FILE", os.path.join(ROOT, "users", "key.txt"))
+
+from common import db, limits, metrics, serve
+
+# Monolith mode: the four services' blueprints mounted in one Flask app, in
+# one process. Every database gets a single connection pool, and the
+# cross-service lookups the services already do in-process (listings,
+# ratings, balances, token verification) share one cache each instead of one
+# per service, with /listing and /clear invalidating them directly.
+#
+# The process listens on one port per service (PORT, default
+# 9000,9001,9002,9003 in SERVICES order) and a request is routed to the
+# blueprint of the port it arrived on, so clients keep their microservice
+# URLs. Every service is also reachable on any port under its name, e.g.
+# /users/login or /payments/metrics.
+#
+#   python3 monolith/app.py
+#   SERVER_MODE=wsgi PORT=9000,9001,9002,9003 python3 monolith/app.py
+
+SERVICES = (
+    ("users", 9000),
+    ("availability", 9001),
+    ("reservations", 9002),
+    ("payments", 9003),
+)
+
+
+def load_service(name):
+    # Every service module is called app.py, so load each one from its file
+    # under its own module name.
+    spec = importlib.util.spec_from_file_location(f"{name}_app", os.path.join(ROOT, name, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+services = {name: load_service(name) for name, _ in SERVICES}
+
+app = Flask(__name__)
+for name, module in services.items():
+    app.register_blueprint(module.bp, url_prefix="/" + name)
+    app.add_url_rule(f"/{name}/metrics", f"{name}_metrics", metrics.metrics_view, methods=["GET"])
+db.init_app(app)
+metrics.init_app(app)
+limits.init_app(app)
+
+
+class PortDispatch:
+    # Prefixes the path with the service that owns the port the request came
+    # in on, unless it already names a service.
+    def __init__(self, app, prefixes):
+        self.app = app
+        self.prefixes = prefixes
+
+    def __call__(self, environ, start_response):
+        prefix = self.prefixes.get(environ.get("SERVER_PORT"))
+        path = environ.get("PATH_INFO", "")
+        if prefix is not None and path.lstrip("/").split("/", 1)[0] not in services:
+            environ["PATH_INFO"] = prefix + path
+        return self.app(environ, start_response)
+
+
+def migrate_dbs():
+    for module in services.values():
+        module.migrate_db()
+
+
+def warm_dbs():
+    for module in services.values():
+        module.warm_db()
+
+
+if __name__ == "__main__":
+    binds = serve.ports("monolith", [port for _, port in SERVICES])
+    prefixes = {str(port): "/" + name for (name, _), port in zip(SERVICES, binds)}
+    serve.run(PortDispatch(app, prefixes), "monolith", binds, init=migrate_dbs, warm=warm_dbs)
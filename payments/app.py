@@ -1,179 +1,121 @@
-import sqlite3
 import os
-import hashlib
-import hmac
-import base64
-import json
-from flask import Flask, request
+import sys
+import threading
+from flask import Blueprint, Flask, request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+from common import db, idempotency, ledger, limits, metrics, migrations, profiles, serve, tokens
 
 # part of this, reuses code from my Project 2 submission for CSE 380.
 # Additional code come from instructor-provided checkpoint examples and lecture
 
-app = Flask(__name__)
-
-DB_NAME = "payments.db"
-SCHEMA_FILE = "schema.sql"
-db_initialized = False
+bp = Blueprint("payments", __name__)
+log = metrics.get_logger("payments")
 
+DB_NAME = db.data_path("payments", "payments.db")
+MIGRATIONS_DIR = os.path.join(HERE, "migrations")
+USERS_DB = db.data_path("users", "users.db")
+IDEMPOTENCY_DB = db.data_path("payments", "idempotency.db")
 
-def create_db():
-    global db_initialized
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.execute("PRAGMA foreign_keys=ON")
+def migrate_db():
+    migrations.migrate(DB_NAME, MIGRATIONS_DIR)
 
-    with open(SCHEMA_FILE, "r") as f:
-        conn.executescript(f.read())
 
-    conn.commit()
-    conn.close()
-    db_initialized = True
+def warm_db():
+    threads = int(serve.setting("payments", "THREADS"))
+    db.preload(DB_NAME)
+    db.warm(DB_NAME, connections=threads)
+    db.warm(USERS_DB, ((profiles.LOOKUP_SQL, ("",)),), connections=threads)
+    tokens.signing_key.get()
 
 
 def get_db():
-    global db_initialized
-    if not db_initialized:
-        create_db()
-
-    conn = sqlite3.connect(DB_NAME)
-    conn.execute("PRAGMA foreign_keys=ON")
-    return conn
-
-
-def validate_token(token):
-
-    try:
-        if token is None:
-            return None
-
-        parts = token.split(".")
-        if len(parts) != 3:
-            return None
-
-        header_b64, payload_b64, signature = parts
-
-        with open("key.txt", "r") as key_file:
-            key = key_file.read().strip()
-
-        msg = f"{header_b64}.{payload_b64}".encode()
-        expected = hmac.new(key.encode(), msg, hashlib.sha256).hexdigest()
+    return db.connect(DB_NAME)
 
-        if not hmac.compare_digest(expected, signature):
-            return None
-
-        payload_json = base64.urlsafe_b64decode(payload_b64.encode()).decode()
-        payload = json.loads(payload_json)
-        username = payload.get("username")
-        return username
-    except Exception as e:
-        return None
 
+def clear_db(vacuum=False):
+    migrate_db()
+    db.truncate(DB_NAME, vacuum)
+    idempotency.clear(IDEMPOTENCY_DB)
 
 
-@app.route("/clear", methods=["GET", "POST"])
+@bp.route("/clear", methods=["GET", "POST"])
 def clear():
-    global db_initialized
-
+    vacuum = request.args.get("vacuum") == "1"
     try:
-        if os.path.exists(DB_NAME):
-            os.remove(DB_NAME)
-        db_initialized = False
+        if request.args.get("async") == "1":
+            threading.Thread(target=clear_db, args=(vacuum,), daemon=True).start()
+        else:
+            clear_db(vacuum)
         return {"status": 1}
     except Exception as e:
         return {"status": 2}
 
 
-@app.route("/add", methods=["POST"])
+@bp.route("/add", methods=["POST"])
+@limits.cost(2)
 def add():
     auth = request.headers.get("Authorization")
-    username = validate_token(auth)
+    username = tokens.validate_token(auth)
     if username is None:
         return {"status": 2}
 
+    return idempotency.handle(IDEMPOTENCY_DB, username, lambda: add_amount(username))
+
+
+def add_amount(username):
     amount_str = request.form.get("amount")
     if amount_str is None:
         return {"status": 2}
 
     try:
-        amount = float(amount_str)
+        amount_cents = ledger.to_cents(amount_str)
     except ValueError:
         return {"status": 2}
 
 
-    if amount <= 0:
+    if amount_cents <= 0:
         return {"status": 2}
 
 
     try:
-        conn_users = sqlite3.connect("../users/users.db")
-        cur_users = conn_users.cursor()
-
-        cur_users.execute("SELECT deposit FROM user WHERE username=?", (username,))
-        row = cur_users.fetchone()
-        if not row:
-            conn_users.close()
+        if profiles.lookup(USERS_DB, username) is None:
             return {"status": 2}
 
-        current_str = row[0] if row[0] is not None else "0.00"
-        try:
-            current = float(current_str)
-        except ValueError:
-            current = 0.0
-
-        new_balance = current + amount
-        new_balance_str = f"{new_balance:.2f}"
-
-        cur_users.execute(
-            "UPDATE user SET deposit=? WHERE username=?",
-            (new_balance_str, username)
-        )
-        conn_users.commit()
-        conn_users.close()
-
-   
-        conn_pay = get_db()
-        cur_pay = conn_pay.cursor()
-        cur_pay.execute(
-            "INSERT INTO payments(username, amount) VALUES(?, ?)",
-            (username, amount_str)
-        )
-        conn_pay.commit()
-        conn_pay.close()
-
+        ledger.get_committer(DB_NAME).submit(username, amount_cents, ledger.DEPOSIT)
         return {"status": 1}
     except Exception as e:
+        log.error("add failed for %s: %s", username, e)
         return {"status": 2}
 
 
-@app.route("/view", methods=["GET"])
+@bp.route("/view", methods=["GET"])
 def view():
     auth = request.headers.get("Authorization")
-    username = validate_token(auth)
+    username = tokens.validate_token(auth)
     if username is None:
         return {"status": 2, "balance": "0.00"}
 
     try:
-        conn_users = sqlite3.connect("../users/users.db")
-        cur_users = conn_users.cursor()
-
-        cur_users.execute("SELECT deposit FROM user WHERE username=?", (username,))
-        row = cur_users.fetchone()
-        conn_users.close()
+        profile = profiles.lookup(USERS_DB, username)
 
-        if not row:
+        if profile is None:
             return {"status": 2, "balance": "0.00"}
 
-        deposit_str = row[0] if row[0] is not None else "0.00"
-        try:
-            bal = float(deposit_str)
-        except ValueError:
-            bal = 0.0
-
-        balance_out = f"{bal:.2f}"
-        return {"status": 1, "balance": balance_out}
+        balance = ledger.opening_cents(profile[0]) + ledger.delta_cents(get_db().cursor(), username)
+        return {"status": 1, "balance": ledger.format_cents(balance)}
     except Exception as e:
         return {"status": 2, "balance": "0.00"}
 
 
+app = Flask(__name__)
+app.register_blueprint(bp)
+db.init_app(app)
+metrics.init_app(app)
+limits.init_app(app)
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=9003, debug=False, use_reloader=False)
+    serve.run(app, "payments", 9003, init=migrate_db, warm=warm_db)
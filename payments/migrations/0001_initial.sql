@@ -0,0 +1,19 @@
+-- Databases created before migrations existed (by the old schema.sql)
+-- only have the old `payments` log, which is left alone: balances were kept
+-- in users.db (user.deposit), and the ledger starts from that.
+
+CREATE TABLE IF NOT EXISTS ledger(
+    entry_id     INTEGER PRIMARY KEY,
+    username     TEXT NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    kind         TEXT NOT NULL,
+    ref          TEXT
+);
+
+CREATE INDEX IF NOT EXISTS ledger_username_entry ON ledger(username, entry_id);
+
+CREATE TABLE IF NOT EXISTS balance_snapshot(
+    username      TEXT PRIMARY KEY,
+    delta_cents   INTEGER NOT NULL,
+    last_entry_id INTEGER NOT NULL
+);
@@ -1,7 +0,0 @@
-DROP TABLE IF EXISTS payments;
-
-CREATE TABLE payments(
-    paymentid INTEGER PRIMARY KEY,
-    username  TEXT,
-    amount    TEXT
-);
\ No newline at end of file
@@ -1,237 +1,229 @@
 import sqlite3
 import os
-import hashlib
-import hmac
-import base64
-import json
-from flask import Flask, request
+import sys
+import threading
+from flask import Blueprint, Flask, request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+from common import booking, db, idempotency, ledger, limits, listings, metrics, migrations, profiles, ratings, searchcache, serve, tokens
 
 # part of this, reuses code from my Project 2 submission for CSE 380.
 # Additional code come from instructor-provided checkpoint examples and lecture
 
-app = Flask(__name__)
-
-DB_NAME = "reservations.db"
-SCHEMA_FILE = "schema.sql"
-db_initialized = False
-
+bp = Blueprint("reservations", __name__)
+log = metrics.get_logger("reservations")
+
+DB_NAME = db.data_path("reservations", "reservations.db")
+MIGRATIONS_DIR = os.path.join(HERE, "migrations")
+USERS_DB = db.data_path("users", "users.db")
+AVAILABILITY_DB = db.data_path("availability", "availability.db")
+PAYMENTS_DB = db.data_path("payments", "payments.db")
+IDEMPOTENCY_DB = db.data_path("reservations", "idempotency.db")
+HISTORY_PAGE_SIZE = 20
+MAX_HISTORY_PAGE_SIZE = 100
+
+# One page of a user's reservations, newest first, from both sides. Each
+# branch reads its own covering index (see migrations/0002_history.sql) and
+# stops after `limit` rows; the UNION drops the duplicate when somebody
+# booked their own listing.
+HISTORY_BRANCH = """
+    SELECT * FROM (
+        SELECT reservation_id, listingid, day, driver, renter, price_cents
+        FROM reservations INDEXED BY reservations_{role}_history
+        WHERE {role} = ?{after}
+        ORDER BY reservation_id DESC
+        LIMIT ?
+    )
+"""
 
-def create_db():
-    global db_initialized
+db.attach(DB_NAME, booking.AVAILABILITY_ALIAS, AVAILABILITY_DB)
+db.attach(DB_NAME, booking.PAYMENTS_ALIAS, PAYMENTS_DB)
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.execute("PRAGMA foreign_keys = ON")
 
-    with open(SCHEMA_FILE, "r") as f:
-        conn.executescript(f.read())
+def migrate_db():
+    migrations.migrate(DB_NAME, MIGRATIONS_DIR)
 
-    conn.commit()
-    conn.close()
 
-    db_initialized = True
+def warm_db():
+    threads = int(serve.setting("reservations", "THREADS"))
+    db.preload(DB_NAME)
+    db.warm(DB_NAME, connections=threads)
+    db.warm(USERS_DB, ((profiles.LOOKUP_SQL, ("",)),), connections=threads)
+    tokens.signing_key.get()
 
 
 def get_db():
-    global db_initialized
-
-    if not db_initialized:
-        create_db()
-
-    conn = sqlite3.connect(DB_NAME)
-    conn.execute("PRAGMA foreign_keys = ON")
-    return conn
-
-def validate_token(token):
+    return db.connect(DB_NAME)
 
+def clear_db(vacuum=False):
+    migrate_db()
+    db.truncate(DB_NAME, vacuum)
+    idempotency.clear(IDEMPOTENCY_DB)
     try:
-        if token is None:
-            return None
-
-        parts = token.split(".")
-        if len(parts) != 3:
-            return None
-
-        header_b64, payload_b64, signature = parts
-
-        with open("key.txt", "r") as key_file:
-            key = key_file.read().strip()
+        with db.checkout(DB_NAME) as conn:
+            booking.release_seats(conn)
+    except sqlite3.OperationalError as e:
+        # availability.db has not been created yet.
+        log.warning("could not release seats: %s", e)
+    searchcache.bump(AVAILABILITY_DB)
 
-        msg = f"{header_b64}.{payload_b64}".encode()
-        expected = hmac.new(key.encode(), msg, hashlib.sha256).hexdigest()
-
-        if not hmac.compare_digest(expected, signature):
-            return None
-
-        payload_json = base64.urlsafe_b64decode(payload_b64.encode()).decode()
-        payload = json.loads(payload_json)
-        username = payload.get("username")
-        return username
-    except Exception as e:
-        return None
 
-@app.route("/clear", methods=["GET", "POST"])
+@bp.route("/clear", methods=["GET", "POST"])
 def clear():
-    global db_initialized
-
+    vacuum = request.args.get("vacuum") == "1"
     try:
-        if os.path.exists(DB_NAME):
-            os.remove(DB_NAME)
-
-        db_initialized = False
+        if request.args.get("async") == "1":
+            threading.Thread(target=clear_db, args=(vacuum,), daemon=True).start()
+        else:
+            clear_db(vacuum)
         return {"status": 1}
 
     except Exception as e:
         return {"status": 2}
 
 
-@app.route("/reserve", methods=["POST"])
+@bp.route("/reserve", methods=["POST"])
+@limits.cost(2)
 def reserve():
 
     auth = request.headers.get("Authorization")
-    username = validate_token(auth)
+    username = tokens.validate_token(auth)
 
     if not username:
         return {"status": 2}
 
+    return idempotency.handle(IDEMPOTENCY_DB, username, lambda: reserve_listing(username))
+
+
+def reserve_listing(username):
     listingid = request.form.get("listingid")
     if not listingid:
         return {"status": 2}
 
-    import urllib.request
-    import urllib.parse
+    try:
+        listing = listings.lookup(AVAILABILITY_DB, listingid)
+        if listing is None:
+            log.debug("listing %s not found", listingid)
+            return {"status": 2}
 
+        profile = profiles.lookup(USERS_DB, username)
+        conn = get_db()
+        status = booking.reserve(conn, username, listingid, listing, profile)
+        if status in (booking.RESERVED, booking.SEATS_CORRECTED):
+            searchcache.bump(AVAILABILITY_DB)
+        if status == booking.SEATS_CORRECTED:
+            status = booking.FAILED
+        return {"status": status}
+    except Exception as e:
+        return {"status": 2}
+
+
+def history_rows(username, cursor, limit):
+    after = " AND reservation_id < ?" if cursor is not None else ""
+    params = [username] + ([cursor] if cursor is not None else []) + [limit]
+    sql = (
+        HISTORY_BRANCH.format(role="renter", after=after)
+        + " UNION "
+        + HISTORY_BRANCH.format(role="driver", after=after)
+        + " ORDER BY reservation_id DESC LIMIT ?"
+    )
+    cur = get_db().cursor()
+    cur.execute(sql, params + params + [limit])
+    return cur.fetchall()
+
+
+def format_history(username, rows):
+    # The other party of each reservation, and the rating username gave
+    # them, fetched for the whole page at once.
+    others = {driver if username == renter else renter for _, _, _, driver, renter, _ in rows}
     try:
-        
-        url = f"http://127.0.0.1:9001/search?day=__all__&listingid={listingid}"
-        req = urllib.request.Request(url, method="GET")
-        with urllib.request.urlopen(req) as resp:
-            _ = resp.read()  
-
-    
-        conn_av = sqlite3.connect("../availability/availability.db")
-        cur_av = conn_av.cursor()
-        cur_av.execute(
-            "SELECT day, price, username FROM availability WHERE listingid=?",
-            (listingid,)
+        given = ratings.given(USERS_DB, username, others)
+    except:
+        given = {}
+
+    data = []
+    for reservation_id, listingid, day, driver, renter, price_cents in rows:
+        if price_cents is not None:
+            price = ledger.format_cents(price_cents)
+        else:
+            try:
+                listing = listings.lookup(AVAILABILITY_DB, listingid)
+                price = ledger.format_cents(ledger.to_cents(listing[1])) if listing else "0.00"
+            except:
+                price = "0.00"
+        other_user = driver if username == renter else renter
+        data.append(
+            {
+                "reservation_id": reservation_id,
+                "listingid": listingid,
+                "day": day,
+                "price": price,
+                "user": other_user,
+                "role": "renter" if username == renter else "driver",
+                "rating": f"{float(given.get(other_user) or 0.0):.2f}",
+            }
         )
-        row = cur_av.fetchone()
-        conn_av.close()
+    return data
 
-        if not row:
-            print("[DEBUG] Listing not found")
-            return {"status": 2}
 
-        day, price_str, driver = row
-        price = float(price_str)
-        conn_user = sqlite3.connect("../users/users.db")
-        cur_user = conn_user.cursor()
-        cur_user.execute("SELECT deposit FROM user WHERE username=?", (username,))
-        user_row = cur_user.fetchone()
+@bp.route("/history", methods=["GET"])
+def history():
+    auth = request.headers.get("Authorization")
+    username = tokens.validate_token(auth)
+    if not username:
+        return {"status": 2}
 
-        if not user_row:
-            conn_user.close()
+    # Keyset pagination: "next" is the last reservation_id on the page and
+    # is passed back as ?cursor=... for the next (older) one.
+    limit = request.args.get("limit")
+    cursor = request.args.get("cursor")
+    try:
+        limit = min(int(limit), MAX_HISTORY_PAGE_SIZE) if limit else HISTORY_PAGE_SIZE
+        if limit < 1:
             return {"status": 2}
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        return {"status": 2}
 
-        balance = float(user_row[0])
-        if balance < price:
-            conn_user.close()
-            return {"status": 3}
-        new_balance = balance - price
-        cur_user.execute(
-            "UPDATE user SET deposit=? WHERE username=?",
-            (f"{new_balance:.2f}", username),
-        )
-        conn_user.commit()
-        conn_user.close()
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO reservations(listingid, day, driver, renter)
-            VALUES(?,?,?,?)
-            """,
-            (listingid, day, driver, username)
-        )
-        conn.commit()
-        conn.close()
+    rows = history_rows(username, cursor, limit)
 
-        return {"status": 1}
+    result = {"status": 1, "data": format_history(username, rows)}
+    if len(rows) == limit:
+        result["next"] = str(rows[-1][0])
+    return result
 
-    except Exception as e:
-        return {"status": 2}
-@app.route("/view", methods=["GET"])
+
+@bp.route("/view", methods=["GET"])
 def view_reservation():
+    # The most recent reservation only; /history pages through all of them.
     auth = request.headers.get("Authorization")
-    username = validate_token(auth)
+    username = tokens.validate_token(auth)
     if not username:
         return {"status": 2}
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT reservation_id, listingid, day, driver, renter
-        FROM reservations
-        WHERE renter = ? OR driver = ?
-        ORDER BY reservation_id DESC
-        LIMIT 1
-        """,
-        (username, username)
-    )
-    row = cur.fetchone()
-    conn.close()
-
-    if not row:
+    rows = history_rows(username, None, 1)
+    if not rows:
         return {"status": 1, "data": {}}
 
-    reservation_id, listingid, day, driver, renter = row
-
-    try:
-        conn_av = sqlite3.connect("../availability/availability.db")
-        cur_av = conn_av.cursor()
-        cur_av.execute(
-            "SELECT price FROM availability WHERE listingid = ?",
-            (listingid,)
-        )
-        row_av = cur_av.fetchone()
-        conn_av.close()
-        price = row_av[0] if row_av else "0.00"
-    except:
-        price = "0.00"
-
-    if username == renter:
-        other_user = driver
-        driver_to_rate = driver
-        rater = username
-    else:
-        other_user = renter
-        driver_to_rate = renter
-        rater = username
-
-    rating_val = 0.0
-    try:
-        conn_users = sqlite3.connect("../users/users.db")
-        cur_u = conn_users.cursor()
-        cur_u.execute(
-            "SELECT AVG(rating) FROM ratings WHERE driver = ? AND rater = ?",
-            (driver_to_rate, rater)
-        )
-        row_r = cur_u.fetchone()
-        conn_users.close()
-        if row_r and row_r[0] is not None:
-            rating_val = float(row_r[0])
-    except:
-        pass
-
+    item = format_history(username, rows)[0]
     return {
         "status": 1,
         "data": {
-            "listingid": listingid,
-            "price": f"{float(price):.2f}",
-            "user": other_user,
-            "rating": f"{rating_val:.2f}",
+            "listingid": item["listingid"],
+            "price": item["price"],
+            "user": item["user"],
+            "rating": item["rating"],
         },
     }
+
+
+app = Flask(__name__)
+app.register_blueprint(bp)
+db.init_app(app)
+metrics.init_app(app)
+limits.init_app(app)
+
+
 if __name__ == "__main__":
- 
-    app.run(host="0.0.0.0", port=9002, debug=False, use_reloader=False)
+    serve.run(app, "reservations", 9002, init=migrate_db, warm=warm_db)
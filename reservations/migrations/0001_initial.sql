@@ -0,0 +1,23 @@
+-- IF NOT EXISTS so databases created before migrations existed (by the
+-- old schema.sql) are adopted as version 1 instead of failing. Those could
+-- book a listing for the same day more than once; the first booking keeps
+-- it, the later ones are dropped so that the unique index can be built.
+
+CREATE TABLE IF NOT EXISTS reservations(
+    reservation_id INTEGER PRIMARY KEY,
+    listingid INTEGER,
+    day TEXT,
+    driver TEXT,
+    renter TEXT
+);
+
+DELETE FROM reservations
+WHERE listingid IS NOT NULL AND day IS NOT NULL
+  AND reservation_id NOT IN (
+      SELECT MIN(reservation_id)
+      FROM reservations
+      WHERE listingid IS NOT NULL AND day IS NOT NULL
+      GROUP BY listingid, day
+  );
+
+CREATE UNIQUE INDEX IF NOT EXISTS reservations_listing_day ON reservations(listingid, day);
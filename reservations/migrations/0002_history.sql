@@ -0,0 +1,10 @@
+-- /history: the price paid is stored on the reservation at booking time
+-- (rows booked before this migration have NULL and fall back to the
+-- listing's price), and each side of "renter = ? OR driver = ?" gets its own
+-- index that covers every column /history returns, so a page is two short
+-- index range reads merged by a UNION instead of a table scan.
+
+ALTER TABLE reservations ADD COLUMN price_cents INTEGER;
+
+CREATE INDEX reservations_renter_history ON reservations(renter, reservation_id, listingid, day, driver, price_cents);
+CREATE INDEX reservations_driver_history ON reservations(driver, reservation_id, listingid, day, renter, price_cents);
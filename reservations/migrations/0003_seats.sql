@@ -0,0 +1,8 @@
+-- Listings can take several reservations (availability.seats); each one
+-- holds a numbered seat, and a seat can only be booked once. Existing rows
+-- hold seat 1, which keeps the old one-booking-per-listing rule for them.
+
+ALTER TABLE reservations ADD COLUMN seat INTEGER NOT NULL DEFAULT 1;
+
+DROP INDEX IF EXISTS reservations_listing_day;
+CREATE UNIQUE INDEX reservations_listing_seat ON reservations(listingid, day, seat);
@@ -1,9 +0,0 @@
-DROP TABLE IF EXISTS reservations;
-
-CREATE TABLE reservations(
-    reservation_id INTEGER PRIMARY KEY,
-    listingid INTEGER,
-    day TEXT,
-    driver TEXT,
-    renter TEXT
-);
\ No newline at end of file
@@ -1,111 +1,92 @@
-import sqlite3
 import os
-import hashlib
-import json
-import hmac
-import base64
-from flask import Flask, request
+import sys
+import threading
+from flask import Blueprint, Flask, request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+from common import credentials, db, limits, metrics, migrations, profiles, searchcache, serve, tokens, writebehind
 
 # part of this, reuses code from my Project 2 submission for CSE 380.
 # Additional code come from instructor-provided checkpoint examples and lecture slides.
 
-app = Flask(__name__)
+bp = Blueprint("users", __name__)
+log = metrics.get_logger("users")
 
-DB_NAME = "users.db"
-SCHEMA_FILE = "schema.sql"
-db_initialized = False
+DB_NAME = db.data_path("users", "users.db")
+MIGRATIONS_DIR = os.path.join(HERE, "migrations")
+AVAILABILITY_DB = db.data_path("availability", "availability.db")
 
+# RATE_WRITE_BEHIND=1 acknowledges /rate once the rating is queued and
+# inserts ratings in batches; by default each one is committed in-request.
+RATE_WRITE_BEHIND = os.environ.get("RATE_WRITE_BEHIND", "0") == "1"
+rating_writer = writebehind.WriteBehindQueue(
+    DB_NAME,
+    "INSERT INTO ratings(driver, rater, rating) VALUES(?,?,?)",
+    "ratings",
+    max_batch=int(os.environ.get("RATE_BATCH_MAX", "256")),
+    max_wait=float(os.environ.get("RATE_BATCH_WAIT_MS", "20")) / 1000.0,
+    capacity=int(os.environ.get("RATE_QUEUE_SIZE", "10000")),
+    put_wait=float(os.environ.get("RATE_QUEUE_WAIT_MS", "50")) / 1000.0,
+    # Search results show driver ratings.
+    on_write=lambda: searchcache.bump(AVAILABILITY_DB),
+)
 
 
-def create_db():
-    global db_initialized
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.execute("PRAGMA foreign_keys=ON")
+def migrate_db():
+    migrations.migrate(DB_NAME, MIGRATIONS_DIR)
 
-    with open(SCHEMA_FILE, "r") as f:
-        conn.executescript(f.read())
 
-    conn.commit()
-    conn.close()
-    db_initialized = True
+def warm_db():
+    db.preload(DB_NAME)
+    db.warm(
+        DB_NAME,
+        (("SELECT hash, salt FROM user WHERE username=?", ("",)),),
+        connections=int(serve.setting("users", "THREADS")),
+    )
+    tokens.signing_key.get()
 
 
 def get_db():
-    global db_initialized
-    if not db_initialized:
-        create_db()
-
-    conn = sqlite3.connect(DB_NAME)
-    conn.execute("PRAGMA foreign_keys=ON")
-    return conn
+    return db.connect(DB_NAME)
 
 
 
-def generate_token(username):
-   
-    with open("key.txt", "r") as key_file:
-        secret = key_file.read().strip().encode()
-
-    header = '{"alg": "HS256", "typ": "JWT"}'
-    payload = '{"username": "' + username + '"}'
-
-    header_b64 = base64.b64encode(header.encode()).decode()
-    payload_b64 = base64.b64encode(payload.encode()).decode()
-
-    signing_input = header_b64 + "." + payload_b64
-
-   
-    signature = hmac.new(secret, signing_input.encode(), hashlib.sha256).hexdigest()
-
-    token = signing_input + "." + signature
-    return token
 def validate_token(token):
-    try:
-        if token is None:
-            return None
-
-        parts = token.split(".")
-        if len(parts) != 3:
-            return None
-
-        header_b64, payload_b64, signature = parts
-
-        with open("key.txt", "r") as key_file:
-            key = key_file.read().strip()
+    username = tokens.validate_token(token)
+    log.debug("token username: %s", username)
+    return username
 
-        msg = f"{header_b64}.{payload_b64}".encode()
-        expected = hmac.new(key.encode(), msg, hashlib.sha256).hexdigest()
 
-        if not hmac.compare_digest(expected, signature):
-            return None
-
-        payload_json = base64.urlsafe_b64decode(payload_b64.encode()).decode()
-        payload = json.loads(payload_json)
-        username = payload.get("username")
-        print("[DEBUG] TOKEN USERNAME:", username)
-        return username
-    except Exception as e:
-        return None
 
+def clear_db(vacuum=False):
+    rating_writer.flush()
+    migrate_db()
+    db.truncate(DB_NAME, vacuum)
+    profiles.invalidate(DB_NAME)
+    searchcache.bump(AVAILABILITY_DB)
+    log.debug("db cleared")
 
 
-@app.route("/clear", methods=["GET", "POST"])
+# ?vacuum=1 also returns the freed space to the filesystem; ?async=1
+# answers right away and clears in the background.
+@bp.route("/clear", methods=["GET", "POST"])
 def clear():
-    global db_initialized
-
+    vacuum = request.args.get("vacuum") == "1"
     try:
-        if os.path.exists(DB_NAME):
-            os.remove(DB_NAME)
-            print("[DEBUG] DB REMOVED")
-        db_initialized = False
+        if request.args.get("async") == "1":
+            threading.Thread(target=clear_db, args=(vacuum,), daemon=True).start()
+        else:
+            clear_db(vacuum)
         return {"status": 1}
     except Exception as e:
-        print("[DEBUG CLEAR ERROR]:", e)
+        log.error("clear failed: %s", e)
         return {"status": 2}
 
 
-@app.route("/create_user", methods=["POST"])
+@bp.route("/create_user", methods=["POST"])
+@limits.cost(5)
 def create_user():
 
   
@@ -114,18 +95,19 @@ def create_user():
         if request.form.get(field) is None:
             return {"status": 2}
 
-    conn = get_db()
-    cur = conn.cursor()
-
     username = request.form["username"]
     password = request.form["password"]
     salt     = request.form["salt"]
     deposit  = request.form["deposit"]
     driver   = request.form["driver"]
 
-   
-    hash_val = hashlib.sha256((password + salt).encode()).hexdigest()
+    try:
+        hash_val = credentials.hash_password(password, salt)
+    except credentials.Overloaded:
+        return {"status": 2}
 
+    conn = get_db()
+    cur = conn.cursor()
     cur.execute(
         """
         INSERT INTO user(first_name,last_name,username,email,hash,salt,driver,deposit)
@@ -144,12 +126,13 @@ def create_user():
     )
 
     conn.commit()
-    conn.close()
+    profiles.invalidate(DB_NAME, username)
     return {"status": 1}
 
 
 
-@app.route("/login", methods=["POST"])
+@bp.route("/login", methods=["POST"])
+@limits.cost(5)
 def login():
 
     username = request.form.get("username")
@@ -165,46 +148,53 @@ def login():
     row = cur.fetchone()
 
     if not row:
-        conn.close()
         return {"status": 2, "jwt": "NULL"}
 
     stored_hash, salt = row
     if not stored_hash or not salt:
-        conn.close()
         return {"status": 2, "jwt": "NULL"}
 
-    check_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-    if check_hash != stored_hash:
-        conn.close()
+    try:
+        matches, needs_rehash = credentials.verify_password(password, salt, stored_hash)
+    except credentials.Overloaded:
+        log.warning("login for %s refused: KDF pool is full", username)
+        return {"status": 2, "jwt": "NULL"}
+    except ValueError:
+        return {"status": 2, "jwt": "NULL"}
+
+    if not matches:
         return {"status": 2, "jwt": "NULL"}
 
-    conn.close()
+    # Upgrade legacy sha256 rows (and rows hashed with old cost settings)
+    # now that we know the plaintext. Losing this race to another login
+    # is harmless, hence the compare-and-set on the old hash.
+    if needs_rehash:
+        try:
+            new_hash = credentials.hash_password(password, salt)
+            cur.execute(
+                "UPDATE user SET hash=? WHERE username=? AND hash=?",
+                (new_hash, username, stored_hash)
+            )
+            conn.commit()
+        except credentials.Overloaded:
+            pass
 
    
-    jwt_token = generate_token(username)
+    jwt_token = tokens.generate_token(username)
 
 
     return {"status": 1, "jwt": jwt_token}
-def get_username_from_auth():
-    auth = request.headers.get("Authorization")
-    if not auth:
-        return None
 
-    try:
-        parts = auth.split(".")
-        if len(parts) != 3:
-            return None
 
-        payload_b64 = parts[1]
-        padding = "=" * ((4 - len(payload_b64) % 4) % 4)
-        payload_json = base64.b64decode(payload_b64 + padding).decode()
+@bp.route("/refresh", methods=["POST"])
+def refresh():
+    jwt_token = tokens.refresh_token(request.headers.get("Authorization"))
+    if jwt_token is None:
+        return {"status": 2, "jwt": "NULL"}
+    return {"status": 1, "jwt": jwt_token}
 
-        payload = json.loads(payload_json)
-        return payload.get("username")
 
-    except:
-        return None
-@app.route("/rate", methods=["POST"])
+@bp.route("/rate", methods=["POST"])
 def rate():
 
     auth = request.headers.get("Authorization")
@@ -235,22 +225,33 @@ def rate():
     cur.execute("SELECT username FROM user WHERE username = ?", (target,))
     row = cur.fetchone()
     if not row:
-        conn.close()
         return {"status": 2}
 
+    if RATE_WRITE_BEHIND:
+        rating_writer.submit((target, rater, rating))
+        return {"status": 1}
+
     try:
         cur.execute(
             "INSERT INTO ratings(driver, rater, rating) VALUES(?,?,?)",
             (target, rater, rating)
         )
         conn.commit()
-        conn.close()
+        searchcache.bump(AVAILABILITY_DB)
         return {"status": 1}
     except Exception as e:
-        conn.close()
+        conn.rollback()
         return {"status": 2}
 
+
+app = Flask(__name__)
+app.register_blueprint(bp)
+db.init_app(app)
+metrics.init_app(app)
+limits.init_app(app)
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=9000, debug=False, use_reloader=False)
+    serve.run(app, "users", 9000, init=migrate_db, warm=warm_db)
 
 
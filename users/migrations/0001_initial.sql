@@ -0,0 +1,60 @@
+-- Databases created before migrations existed (by the old schema.sql)
+-- already have `user`, which is kept as it is, and a `ratings` table
+-- without rating_id, which is rebuilt. driver_rating_summary is filled in
+-- from the ratings that are already there before its trigger takes over.
+-- On a new database this copies nothing.
+
+CREATE TABLE IF NOT EXISTS user(
+    user_id INTEGER PRIMARY KEY,
+    first_name TEXT,
+    last_name TEXT,
+    username TEXT UNIQUE,
+    email TEXT,
+    hash TEXT,
+    salt TEXT,
+    driver BOOLEAN,
+    deposit TEXT
+);
+
+CREATE TABLE IF NOT EXISTS ratings(
+    driver TEXT,
+    rater TEXT,
+    rating INTEGER
+);
+
+CREATE TABLE ratings_v1(
+    rating_id INTEGER PRIMARY KEY,
+    driver TEXT,
+    rater TEXT,
+    rating INTEGER
+);
+
+INSERT INTO ratings_v1(driver, rater, rating)
+SELECT driver, rater, rating FROM ratings ORDER BY rowid;
+
+DROP TABLE ratings;
+ALTER TABLE ratings_v1 RENAME TO ratings;
+
+-- Also serves lookups by driver alone.
+CREATE INDEX ratings_driver_rater ON ratings(driver, rater);
+
+CREATE TABLE driver_rating_summary(
+    driver TEXT PRIMARY KEY,
+    rating_sum INTEGER NOT NULL,
+    rating_count INTEGER NOT NULL
+);
+
+INSERT INTO driver_rating_summary(driver, rating_sum, rating_count)
+SELECT driver, SUM(rating), COUNT(rating)
+FROM ratings
+WHERE driver IS NOT NULL AND rating IS NOT NULL
+GROUP BY driver;
+
+CREATE TRIGGER ratings_summary_insert AFTER INSERT ON ratings
+BEGIN
+    INSERT INTO driver_rating_summary(driver, rating_sum, rating_count)
+    VALUES(NEW.driver, NEW.rating, 1)
+    ON CONFLICT(driver) DO UPDATE SET
+        rating_sum = rating_sum + NEW.rating,
+        rating_count = rating_count + 1;
+END;